@@ -0,0 +1,177 @@
+#=============================HACHURE BENCHMARK=============================
+# Times the hachure script on the sample DEM and on made-up DEMs of
+# growing size, across a grid of settings, so that we notice when a
+# change makes things slower. Run it with the Python that comes with
+# QGIS, from the folder holding the scripts:
+#
+#   python "Hachure Benchmark.py" --output today.json
+#
+# and later compare a new run against that one:
+#
+#   python "Hachure Benchmark.py" --compare today.json
+#
+# Made-up DEMs are built from a fixed seed, and the hachure script is
+# given a fixed random_seed too, so every run does exactly the same work.
+
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal, osr
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+
+#-------Loads "Hachure Generator.py", which can't simply be imported------
+def load_generator():
+    spec = importlib.util.spec_from_file_location(
+        'hachure_generator',
+        os.path.join(script_folder, 'Hachure Generator.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['hachure_generator'] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+#------------Makes a smooth, hilly DEM that's the same every time---------
+def synthetic_dem(path,size,seed = 1):
+    rng = np.random.default_rng(seed)
+    y,x = np.mgrid[0:size,0:size] / size
+
+    # A few dozen overlapping round hills of different sizes
+    elevation = np.zeros((size, size))
+    for i in range(24):
+        centre_x,centre_y = rng.uniform(0, 1, 2)
+        width = rng.uniform(0.05, 0.3)
+        height = rng.uniform(50, 400)
+        distance = (x - centre_x)**2 + (y - centre_y)**2
+        elevation += height * np.exp(-distance / (2 * width**2))
+
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        path, size, size, 1, gdal.GDT_Float32)
+
+    # 10m pixels, somewhere in a projected coordinate system
+    dataset.SetGeoTransform((0, 10, 0, size * 10, 0, -10))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    dataset.SetProjection(srs.ExportToWkt())
+
+    dataset.GetRasterBand(1).WriteArray(elevation.astype(np.float32))
+    dataset.FlushCache()
+
+#--------------------Times one run of the hachure script------------------
+def run_case(generator,dem_path,spacing_checks,spacing):
+    params = generator.HachureParameters(
+        spacing_checks = spacing_checks,
+        min_hachure_spacing = spacing[0],
+        max_hachure_spacing = spacing[1],
+        random_seed = 1,
+        cache_size = 0) # so that every run does the full amount of work
+
+    start = time.perf_counter()
+    features = generator.generate_hachures(dem_path, params)
+    seconds = time.perf_counter() - start
+
+    return {
+        'seconds': seconds,
+        'hachures': len(features),
+        'digest': generator.output_digest(features),
+        'timings': generator.timing_report()
+    }
+
+#-----Finds cases that got slower than the tolerance allows since before---
+def regressions(results,baseline,tolerance):
+    slower = []
+
+    for case,result in results.items():
+        if case not in baseline:
+            continue
+        before = baseline[case]['seconds']
+        after = result['seconds']
+        if after > before * (1 + tolerance):
+            slower.append((case, before, after))
+
+    return slower
+
+#--------Finds cases whose hachures aren't exactly the same as before-----
+def changed_outputs(results,baseline):
+    # A change that's only meant to make things faster shouldn't move a
+    # single hachure, and with a fixed seed every run is repeatable
+    return [case for case,result in results.items()
+            if case in baseline and 'digest' in baseline[case]
+            and result['digest'] != baseline[case]['digest']]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Time the hachure script over a grid of settings.')
+    parser.add_argument('--sizes', type = int, nargs = '*',
+                        default = [250, 500, 1000, 2000],
+                        help = 'sides, in pixels, of the made-up DEMs')
+    parser.add_argument('--spacing-checks', type = int, nargs = '+',
+                        default = [125, 300])
+    parser.add_argument('--spacings', nargs = '+', default = ['2,6', '4,12'],
+                        help = 'min,max hachure spacing pairs')
+    parser.add_argument('--output', metavar = 'PATH',
+                        help = 'save the results to this JSON file')
+    parser.add_argument('--compare', metavar = 'PATH',
+                        help = 'an earlier JSON file to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'how much slower (0.2 = 20%%) a case may '
+                               'get before it counts as a regression')
+    args = parser.parse_args()
+
+    generator = load_generator()
+    qgis_app = generator.start_qgis()
+
+    # The made-up DEMs can be big, so they're deleted again at the end
+    work_folder = tempfile.mkdtemp(prefix = 'hachure_benchmark_')
+    try:
+        dems = {'SampleDEM': os.path.join(script_folder, 'SampleDEM.tif')}
+        for size in args.sizes:
+            path = os.path.join(work_folder, f'synthetic_{size}.tif')
+            synthetic_dem(path, size)
+            dems[f'synthetic_{size}'] = path
+
+        spacings = [tuple(float(v) for v in pair.split(','))
+                    for pair in args.spacings]
+
+        results = {}
+        for (name,path),checks,spacing in itertools.product(
+                dems.items(), args.spacing_checks, spacings):
+            case = (f'{name} checks={checks} '
+                    f'spacing={spacing[0]:g}-{spacing[1]:g}')
+            results[case] = run_case(generator, path, checks, spacing)
+            print(f'{case:<48}{results[case]["seconds"]:>9.2f}s'
+                  f'{results[case]["hachures"]:>9} hachures')
+    finally:
+        shutil.rmtree(work_folder, ignore_errors = True)
+
+    qgis_app.exitQgis()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        slower = regressions(results, baseline, args.tolerance)
+        for case,before,after in slower:
+            print(f'SLOWER: {case} went from {before:.2f}s to {after:.2f}s')
+
+        changed = changed_outputs(results, baseline)
+        for case in changed:
+            print(f'CHANGED: {case} made different hachures than before')
+
+        if slower or changed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
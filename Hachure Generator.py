@@ -29,32 +29,159 @@ max_slope_val = 75
 
 thickness_layer = False
 
-DEM = iface.activeLayer() #The layer of interest must be selected
+# For web maps with many zoom levels. The hachures as set up above are
+# for lod_zoom; each of the lod_levels zooms out from there has them
+# twice as far apart. Every hachure is made once, & each stretch of it
+# gets a MinZoom field: the furthest-out zoom it should be shown at.
+# 0 turns this off.
+
+lod_levels = 0
+lod_zoom = 16
+
+#==========================ADVANCED PARAMETERS==========================
+# These only change how the script goes about its work, not what the
+# hachures look like. The defaults should suit most people.
+
+# If True, all new hachures are traced downhill together using NumPy
+# arrays. If False, each hachure is traced one point at a time. Both
+# give the same lines; the first is much faster.
+
+vectorized_tracing = True
+
+# Rasters bigger than this many megabytes are memory-mapped to a
+# temporary file instead of being held in RAM
+
+max_raster_memory = 2000
+
+# Slope & aspect are worked out together in NumPy, in one read of the
+# DEM, the same way QGIS's own Slope & Aspect tools do it. False uses
+# those tools instead.
+
+native_terrain = True
+
+# Rather than building a polygon of all the ground above each contour &
+# clipping hachures against it, hachures can be cut where the DEM's
+# elevation along them rises past the contour's level. Where that's not
+# clear-cut, they're cut right where they cross the contour line. Much
+# faster, but the cuts can move by a fraction of a pixel.
+
+raster_clipping = False
+
+# Large DEMs can be processed in square tiles of this many pixels on a
+# side, so that only one tile's rasters & contours are worked on at a
+# time. Each tile is padded with ~460px of overlap so hachures crossing
+# its edges can be traced in full, so tiles much smaller than 2000px
+# mostly repeat work. 0 processes the whole DEM in one go.
+
+tile_size = 0
+
+# In tiled mode, the tiles can be shared out among this many processes
+# so that several CPU cores work at once. 1 does the tiles one by one.
+# This needs the script to be run from a file saved on disk.
+
+parallel_workers = 1
+
+# Where hachures are too close together, which one stops is chosen at
+# random. A whole number here makes the same choices on every run, so
+# the output can be reproduced. None makes fresh choices each time.
+
+random_seed = None
+
+# Slope & aspect are kept on disk between runs, so that trying
+# out new settings on the same DEM doesn't remake them every time. This
+# is how many megabytes they may take up before the least recently used
+# are deleted. 0 turns this off.
+
+cache_size = 2000
+
+# While the hachures are being checked against one contour, a second
+# thread can be getting this many of the next contours ready (their
+# polygons, rings & slope profiles), so two CPU cores are kept busy.
+# 0 does everything in turn.
+
+prefetch_contours = 0
+
+# If True, a table of how long each stage took (and how much work it
+# did) is printed at the end, which helps in finding what's slow
+
+show_timings = False
+
+# When writing to a file from the command line, finished hachures are
+# written out in batches of this many as the script goes, rather than
+# all kept in memory until the end
+
+write_batch_size = 5000
+
+# Long runs can save their progress to this file every checkpoint_every
+# contours. If the run is interrupted, running again with resume = True
+# picks up from the last save. None turns this off. Only untiled runs
+# (tile_size = 0) save checkpoints.
+
+checkpoint_file = None
+checkpoint_every = 25
+resume = False
+
+# The DEM is whichever layer is selected when the script is run
 
 #============================PREPATORY WORK=============================
 #--------STEP 0: Import various modules and such that are needed--------
 
 import math
-import statistics
 import random
+import os
+import pickle
+import sys
+import tempfile
+import argparse
+import bisect
+import gzip
+import hashlib
+import importlib.util
+import json
+import shutil
+import struct
+import threading
+import time
+import multiprocessing
 
 from collections import defaultdict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, fields
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+from osgeo import gdal, ogr
 
 from qgis.PyQt.QtCore import (
     QVariant
 )
 from qgis.utils import iface
 from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsMapLayer,
     QgsProject,
     QgsRasterLayer,
     QgsVectorLayer,
     QgsField,
+    QgsFields,
     QgsMemoryProviderUtils,
     QgsProcessingFeatureSourceDefinition,
+    QgsProcessingUtils,
+    QgsFeatureRequest,
+    QgsRectangle,
     QgsPointXY,
     QgsGeometry,
+    QgsLineString,
     QgsFeature,
+    QgsSpatialIndex,
     QgsWkbTypes,
+    QgsLineSymbol,
+    QgsGraduatedSymbolRenderer,
+    QgsVectorFileWriter,
     edit
 )
 from qgis import processing
@@ -100,97 +227,549 @@ def warn_user(error_type):
             Qgis.Critical),
         12: ('Raster has NULL values.&nbsp;Script is not yet able to'
             ' handle these situations.',
+            Qgis.Critical),
+        13: ('parallel_workers needs the script to be run from a saved '
+             'file.&nbsp;Tiles will be processed one at a time.',
+            Qgis.Warning),
+        14: ('The checkpoint was saved with different settings or a '
+             'different DEM,&nbsp;so the run cannot be resumed from it.',
+            Qgis.Critical),
+        15: ('Resuming a run that writes as it goes needs a .gpkg output '
+             'file.',
+            Qgis.Critical),
+        16: ('The old DEM does not cover the same pixels as the new one,'
+             '&nbsp;so the two cannot be compared.',
+            Qgis.Critical),
+        17: ('The earlier hachures are missing the Hachure,&nbsp;StartX '
+             'or StartY fields,&nbsp;so they cannot be updated.&nbsp;'
+             'Make them again in full first.',
+            Qgis.Critical),
+        18: ('checkpoint_every must be at least 1.',
+            Qgis.Critical),
+        19: ('parallel_workers must be at least 1.',
+            Qgis.Critical),
+        20: ('tile_size must not be less than 0.',
             Qgis.Critical)
     }
     
     err = error_dict[error_type]
     
-    iface.messageBar().pushMessage('Hachure Script',*err)
+    # Outside of the QGIS window (in worker processes, or when run from
+    # the command line) there's no message bar, so print it instead
+    if iface is not None:
+        iface.messageBar().pushMessage('Hachure Script',*err)
+    elif err[1] != Qgis.Critical:
+        text = err[0].replace('&nbsp;',' ').replace('&nbsp',' ')
+        print('Hachure Script: ' + text, file = sys.stderr)
     
     if err[1] == Qgis.Critical:
         raise Exception(err[0])
 
+#-----Reads a raster band into a NumPy array, or a memory map if huge---
+def load_raster_array(path,window):
+    # Only the part of the raster covered by the window is read
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    width = window.width
+    height = window.height
+    
+    # Keep the band's own data type; it is only widened when sampled
+    dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+    size_mb = width * height * dtype.itemsize / 2**20
+    
+    if size_mb <= max_raster_memory:
+        return np.ascontiguousarray(band.ReadAsArray(
+            window.col_off, window.row_off, width, height))
+    
+    # Too big, so copy it strip by strip into a temporary file on disk
+    # that the OS pages in as needed. The file vanishes when we're done
+    array = np.memmap(tempfile.TemporaryFile(), dtype = dtype,
+                      mode = 'w+', shape = (height, width))
+    
+    strip_rows = max(1, (64 * 2**20) // (width * dtype.itemsize))
+    for top in range(0, height, strip_rows):
+        strip_height = min(strip_rows, height - top)
+        array[top:top + strip_height] = band.ReadAsArray(
+            window.col_off, window.row_off + top, width, strip_height)
+    
+    array.flush()
+    return array
+
+#-------All of the parameters above, for running without the console----
+@dataclass
+class HachureParameters:
+    min_hachure_spacing: float = 2
+    max_hachure_spacing: float = 6
+    spacing_checks: int = 125
+    min_slope_val: float = 20
+    max_slope_val: float = 75
+    thickness_layer: bool = False
+    lod_levels: int = 0
+    lod_zoom: int = 16
+    vectorized_tracing: bool = True
+    max_raster_memory: float = 2000
+    native_terrain: bool = True
+    raster_clipping: bool = False
+    tile_size: int = 0
+    parallel_workers: int = 1
+    random_seed: Optional[int] = None
+    cache_size: float = 2000
+    prefetch_contours: int = 0
+    show_timings: bool = False
+    write_batch_size: int = 5000
+    checkpoint_file: Optional[str] = None
+    checkpoint_every: int = 25
+    resume: bool = False
+
+def use_parameters(params):
+    # The functions below read the parameters as plain global names,
+    # just as if they'd been typed in at the top of the script
+    globals().update(asdict(params))
+
+#==========TIMINGS: Keeping track of where the time goes===============
+# Seconds spent in each stage, and tallies of the work done. Stages can
+# sit inside one another (segment slopes run within split_by_hachures),
+# so the times overlap & shouldn't be added up
+stage_times = defaultdict(float)
+counters = defaultdict(int)
+
+# The prefetch thread times & counts its work too, so they take turns
+timings_lock = threading.Lock()
+
+#-------Times a stage; works on a block of code or a whole function------
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with timings_lock:
+            stage_times[stage] += seconds
+
+#-----------------------Adds to one of the tallies-----------------------
+def count(name,amount = 1):
+    with timings_lock:
+        counters[name] += amount
+
+def reset_timings():
+    stage_times.clear()
+    counters.clear()
+
+#---------------The most memory this process has used so far------------
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None # Not available on Windows
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # Linux reports this in kilobytes, but macOS in bytes
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+#------------Everything timed so far, e.g. for saving as JSON-----------
+def timing_report():
+    return {
+        'stages': dict(stage_times),
+        'counts': dict(counters),
+        'peak_memory_mb': peak_memory_mb()
+    }
+
+def add_timings(report):
+    # Folds in a report from elsewhere, such as a worker process
+    for stage,seconds in report['stages'].items():
+        with timings_lock:
+            stage_times[stage] += seconds
+    for name,amount in report['counts'].items():
+        count(name,amount)
+
+def timing_table():
+    lines = [f'{"Stage":<28}{"Seconds":>10}']
+    for stage,seconds in sorted(stage_times.items(),
+                                key = lambda item: -item[1]):
+        lines.append(f'{stage:<28}{seconds:>10.2f}')
+    
+    lines.append('')
+    lines.append(f'{"Count":<28}{"Total":>10}')
+    for name,amount in sorted(counters.items()):
+        lines.append(f'{name:<28}{amount:>10}')
+    
+    peak = peak_memory_mb()
+    if peak is not None:
+        lines.append('')
+        lines.append(f'{"Peak memory (MB)":<28}{peak:>10.0f}')
+    
+    return '\n'.join(lines)
+
+#=======CACHE: Reusing slope/aspect/contours from earlier runs=========
+cache_folder = os.path.join(tempfile.gettempdir(), 'hachure_cache')
+
+# Cache entries used during this run, which must not be cleared out
+# from under us while we're still reading them
+cache_in_use = set()
+
+# How many DEM files' hashes are remembered in hashes.json
+hash_memo_size = 50
+
+#--------Fingerprints the DEM file, so we know when it has changed------
+def file_hash(path):
+    # Hashing a big DEM takes a moment, so the result is remembered for
+    # as long as the file's size & modification time stay the same
+    status = os.stat(path)
+    memo_key = f'{os.path.abspath(path)}|{status.st_size}|{status.st_mtime_ns}'
+    memo_path = os.path.join(cache_folder, 'hashes.json')
+    
+    try:
+        with open(memo_path) as memo_file:
+            memo = json.load(memo_file)
+    except (OSError, ValueError):
+        memo = {}
+    
+    if memo_key in memo:
+        return memo[memo_key]
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as dem_file:
+        for chunk in iter(lambda: dem_file.read(2**20), b''):
+            digest.update(chunk)
+    
+    # Older hashes of this same file are no use any more, & only the most
+    # recent few files are remembered so the memo doesn't keep growing
+    file_prefix = memo_key.rsplit('|', 2)[0] + '|'
+    memo = {key: value for key,value in memo.items()
+            if not key.startswith(file_prefix)}
+    memo[memo_key] = digest.hexdigest()
+    memo = dict(list(memo.items())[-hash_memo_size:])
+    
+    with open(memo_path, 'w') as memo_file:
+        json.dump(memo, memo_file)
+    
+    return memo[memo_key]
+
+#------Makes some files with make(folder), or reuses them from before----
+def cached_files(key_parts,names,make):
+    # make is given a folder to write the named files into. Returns the
+    # paths of those files
+    if cache_size <= 0 or dem_hash is None:
+        # Not kept, so they go where processing's temporary outputs go,
+        # which QGIS clears out when it closes
+        folder = tempfile.mkdtemp(prefix = 'hachure_',
+                                  dir = QgsProcessingUtils.tempFolder())
+        make(folder)
+        return [os.path.join(folder, name) for name in names]
+    
+    key = repr((dem_hash,) + tuple(key_parts))
+    entry = os.path.join(cache_folder,
+                         hashlib.sha256(key.encode()).hexdigest()[:32])
+    outputs = [os.path.join(entry, name) for name in names]
+    cache_in_use.add(entry)
+    
+    if os.path.exists(entry):
+        os.utime(entry) # marks it as recently used
+        return outputs
+    
+    # Work in a scratch folder and only rename it into place once it's
+    # finished, so an interrupted run never leaves a half-made entry
+    scratch = f'{entry}.{os.getpid()}.partial'
+    shutil.rmtree(scratch, ignore_errors = True)
+    os.makedirs(scratch)
+    
+    make(scratch)
+    
+    try:
+        os.replace(scratch, entry)
+    except OSError:
+        # Another process got there first with the very same output
+        shutil.rmtree(scratch, ignore_errors = True)
+    
+    trim_cache()
+    
+    return outputs
+
+#------Runs a processing algorithm, or reuses its output from before-----
+def cached_run(algorithm,parameters,key_parts):
+    # Rasters come out as GeoTIFFs & vectors as GeoPackages
+    name = 'output' + ('.tif' if algorithm.startswith('qgis:') else '.gpkg')
+    
+    def make(folder):
+        processing.run(algorithm,
+                       dict(parameters, OUTPUT = os.path.join(folder, name)))
+    
+    return cached_files([algorithm] + list(key_parts), [name], make)[0]
+
+#------Deletes the least recently used entries once over cache_size-----
+def trim_cache():
+    entries = []
+    
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if not os.path.isdir(path) or name.endswith('.partial'):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+    
+    entries.sort()
+    total = sum(size for mtime,size,path in entries)
+    
+    for mtime,size,path in entries:
+        if total <= cache_size * 2**20:
+            break
+        if path in cache_in_use:
+            continue
+        shutil.rmtree(path, ignore_errors = True)
+        total -= size
+
 #------------------STEP ½: Handling Basic Input Errors------------------
+def check_inputs():
+    checks = [
+        (DEM is None or not DEM.isValid() or
+         DEM.type() != QgsMapLayer.RasterLayer, 1),
+        (min_slope_val < 0,2),
+        (min_slope_val >= max_slope_val,3),
+        (max_slope_val > 100,4),
+        (min_hachure_spacing > max_hachure_spacing,5),
+        (min_hachure_spacing <= 0,6),
+        (max_hachure_spacing <= 0,7),
+        (min_slope_val == 0,8),
+        (spacing_checks < 25,9),
+        (spacing_checks > 300,10),
+        (checkpoint_every < 1,18),
+        (parallel_workers < 1,19),
+        (tile_size < 0,20)
+    ]
+
+    for condition,code in checks:
+        if condition:
+            warn_user(code)
+            break
+
+#---------Differences across one row or column of a 3x3 window----------
+def horn_difference(before,centre,after):
+    # Like QGIS, where one end has no data we fall back on the difference
+    # from the middle, at half the weight. NaN marks no data
+    has_before = ~np.isnan(before)
+    has_after = ~np.isnan(after)
+    has_centre = ~np.isnan(centre)
+    
+    both = has_before & has_after
+    only_before = has_before & ~has_after & has_centre
+    only_after = has_after & ~has_before & has_centre
+    
+    difference = np.where(both, after - before, 0.0)
+    difference = np.where(only_before, centre - before, difference)
+    difference = np.where(only_after, after - centre, difference)
+    weight = np.where(both, 2, np.where(only_before | only_after, 1, 0))
+    
+    return difference,weight
+
+#------Horn's slope & aspect for a strip of the DEM, all in one go------
+def horn_slope_aspect(z,cell_x,cell_y):
+    # z has one extra row above & below the strip (NaN past the DEM's
+    # edges). Returns slope & aspect in degrees, NaN where there's none
+    z = np.pad(z, ((0, 0), (1, 1)), constant_values = np.nan)
+    height = z.shape[0] - 2
+    width = z.shape[1] - 2
+    
+    # East-west: across the top, middle & bottom rows, weighted 1, 2, 1
+    x_sum = 0
+    x_weight = 0
+    for row,w in ((0, 1), (1, 2), (2, 1)):
+        strip = z[row:row + height]
+        difference,weight = horn_difference(
+            strip[:,:-2], strip[:,1:-1], strip[:,2:])
+        x_sum = x_sum + w * difference
+        x_weight = x_weight + w * weight
+    
+    # North-south: down the left, middle & right columns, likewise
+    y_sum = 0
+    y_weight = 0
+    for col,w in ((0, 1), (1, 2), (2, 1)):
+        strip = z[:,col:col + width]
+        difference,weight = horn_difference(
+            strip[2:], strip[1:-1], strip[:-2])
+        y_sum = y_sum + w * difference
+        y_weight = y_weight + w * weight
+    
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        dz_dx = x_sum / (x_weight * cell_x)
+        dz_dy = y_sum / (y_weight * cell_y)
+    
+    missing = (np.isnan(z[1:-1,1:-1]) | (x_weight == 0) | (y_weight == 0))
+    
+    slope = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+    slope[missing] = np.nan
+    
+    # Aspect faces downhill, clockwise from north. Dead flat ground
+    # doesn't face anywhere
+    aspect = 180 + np.degrees(np.arctan2(dz_dx, dz_dy))
+    aspect[missing | ((dz_dx == 0) & (dz_dy == 0))] = np.nan
+    
+    return slope,aspect
+
+#-------Writes slope.tif & aspect.tif for the DEM, a strip at a time----
+def native_slope_aspect(folder):
+    dataset = gdal.Open(dem_path)
+    band = dataset.GetRasterBand(1)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    nodata = band.GetNoDataValue()
+    transform = dataset.GetGeoTransform()
+    cell_x = abs(transform[1])
+    cell_y = abs(transform[5])
+    
+    # Same format & no data value as QGIS's tools give
+    outputs = []
+    for name in ('slope.tif', 'aspect.tif'):
+        output = gdal.GetDriverByName('GTiff').Create(
+            os.path.join(folder, name), width, height, 1,
+            gdal.GDT_Float32, ['BIGTIFF=IF_SAFER'])
+        output.SetGeoTransform(transform)
+        output.SetProjection(dataset.GetProjection())
+        output.GetRasterBand(1).SetNoDataValue(-9999)
+        outputs.append(output)
+    
+    strip_rows = max(1, (64 * 2**20) // (width * 8))
+    for top in range(0, height, strip_rows):
+        strip_height = min(strip_rows, height - top)
+        
+        # Read one row either side too, where there is one
+        first = max(0, top - 1)
+        last = min(height, top + strip_height + 1)
+        z = band.ReadAsArray(0, first, width, last - first)
+        z = z.astype(np.float64)
+        if nodata is not None:
+            z[z == nodata] = np.nan
+        
+        edge = np.full((1, width), np.nan)
+        if first == top:
+            z = np.vstack([edge, z])
+        if last == top + strip_height:
+            z = np.vstack([z, edge])
+        
+        for output,values in zip(outputs,
+                                 horn_slope_aspect(z, cell_x, cell_y)):
+            values = np.where(np.isnan(values), -9999, values)
+            output.GetRasterBand(1).WriteArray(
+                values.astype(np.float32), 0, top)
+    
+    for output in outputs:
+        output.FlushCache()
+
+#------------STEP 1: Get slope/aspect using built in tools--------------
+def prepare_terrain():
+    # Everything set up here is shared by the functions further down
+    global dem_path, contour_interval, slope_layer, aspect_layer
+    global min_slope, max_slope, instance, dem_extent, dem_rows, dem_cols
+    global cell_width, cell_height, average_pixel_size, jump_distance
+    global min_spacing, max_spacing, spacing_range, slope_range, dem_hash
+    
+    dem_path = DEM.source()
+    
+    # Outputs can only be cached for DEMs that are plain files on disk.
+    # Checkpoints keep the hash too, to tell if the DEM has changed since
+    dem_hash = None
+    if (cache_size > 0 or checkpoint_file) and os.path.isfile(dem_path):
+        os.makedirs(cache_folder, exist_ok = True)
+        dem_hash = file_hash(dem_path)
+    
+    stats = DEM.dataProvider().bandStatistics(1)
+    elevation_range = stats.maximumValue - stats.minimumValue
+    contour_interval = elevation_range / spacing_checks
 
-checks = [
-    (iface.activeLayer().type() != QgsMapLayer.RasterLayer, 1),
-    (min_slope_val < 0,2),
-    (min_slope_val >= max_slope_val,3),
-    (max_slope_val > 100,4),
-    (min_hachure_spacing > max_hachure_spacing,5),
-    (min_hachure_spacing <= 0,6),
-    (max_hachure_spacing <= 0,7),
-    (min_slope_val == 0,8),
-    (spacing_checks < 25,9),
-    (spacing_checks > 300,10)
-]
+    parameters = {
+        'INPUT': DEM,
+        'BAND': 1
+    }
+    with timed('slope & aspect'):
+        if native_terrain and gdal.Open(dem_path) is not None:
+            # Both at once, from a single read of the DEM
+            slope_path,aspect_path = cached_files(
+                ['native slope & aspect', 1],
+                ['slope.tif', 'aspect.tif'], native_slope_aspect)
+        else:
+            slope_path = cached_run('qgis:slope', parameters, [1])
+            aspect_path = cached_run('qgis:aspect', parameters, [1])
+        
+        slope_layer = QgsRasterLayer(slope_path,'Slope')
+        aspect_layer = QgsRasterLayer(aspect_path,'Aspect')
+
+    # The contours are made later on, for each window of the DEM in turn.
+    # Their levels are multiples of contour_interval, which is worked out
+    # from the whole DEM, so neighbouring tiles always agree on them.
+
+    #----Convert min_slope_val & max_slope_val to actual slope values----
+    slope_stats = slope_layer.dataProvider().bandStatistics(1)
+    slope_maximum = slope_stats.maximumValue
+    slope_minimum = slope_stats.minimumValue
+    slope_range = slope_maximum - slope_minimum
 
-for condition,code in checks:
-    if condition:
-        warn_user(code)
-        break
+    min_slope = slope_range * (min_slope_val / 100) + slope_minimum
+    max_slope = slope_range * (max_slope_val / 100) + slope_minimum
 
-#---------STEP 1: Get slope/aspect/contours using built in tools--------
-stats = DEM.dataProvider().bandStatistics(1)
-elevation_range = stats.maximumValue - stats.minimumValue
-contour_interval = elevation_range / spacing_checks
+    #-------STEP 2: Set up variables & prepare rasters for reading-------
+    instance = QgsProject.instance()
 
-parameters = {
-    'INPUT': DEM,
-    'BAND': 1,
-    'OUTPUT': 'TEMPORARY_OUTPUT'
-}
-slope_layer = QgsRasterLayer(
-    processing.run('qgis:slope', parameters)['OUTPUT'],'Slope')
-aspect_layer = QgsRasterLayer(
-    processing.run('qgis:aspect', parameters)['OUTPUT'],'Aspect')
+    provider = slope_layer.dataProvider()
+    dem_extent = provider.extent()
+    dem_rows = slope_layer.height()
+    dem_cols = slope_layer.width()
 
-parameters['INTERVAL'] = contour_interval
-filled_contours = QgsVectorLayer(processing.run('gdal:contour_polygon',
-    parameters)['OUTPUT'], "Contour Layer", "ogr")
-line_contours = QgsVectorLayer(processing.run('gdal:contour',
-    parameters)['OUTPUT'], "Contour Layer", "ogr")
+    cell_width = dem_extent.width() / dem_cols
+    cell_height = dem_extent.height() / dem_rows
 
-#-----Convert min_slope_val & max_slope_val to actual slope values-----
-slope_stats = slope_layer.dataProvider().bandStatistics(1)
-slope_maximum = slope_stats.maximumValue
-slope_minimum = slope_stats.minimumValue
-slope_range = slope_maximum - slope_minimum
+    average_pixel_size = 0.5 * (slope_layer.rasterUnitsPerPixelX() +
+                      slope_layer.rasterUnitsPerPixelY())
+    jump_distance = average_pixel_size * 3
 
-min_slope = slope_range * (min_slope_val / 100) + slope_minimum
-max_slope = slope_range * (max_slope_val / 100) + slope_minimum
+    min_spacing = average_pixel_size * min_hachure_spacing
+    max_spacing = average_pixel_size * max_hachure_spacing
 
-#--------STEP 2: Set up variables & prepare rasters for reading---------
-instance = QgsProject.instance()
+    spacing_range = max_spacing - min_spacing
+    slope_range = max_slope - min_slope
 
-provider = slope_layer.dataProvider()
-extent = provider.extent()
-rows = slope_layer.height()
-cols = slope_layer.width()
-slope_block = provider.block(1, extent, cols, rows)
+# The sampling functions below read from extent, rows, cols and the
+# slope & aspect arrays. These describe whichever window of the DEM is
+# being worked on, and are set up by open_window.
 
-aspect_block = aspect_layer.dataProvider().block(1, extent, cols, rows)
+extent = None
+rows = None
+cols = None
+slope_array = None
+aspect_array = None
+elevation_array = None # only read for raster_clipping
 
-cell_width = extent.width() / cols
-cell_height = extent.height() / rows
+# When tiles are shared among processes, the whole slope & aspect
+# rasters sit in shared memory & each window is just a view onto them
 
-average_pixel_size = 0.5 * (slope_layer.rasterUnitsPerPixelX() +
-                  slope_layer.rasterUnitsPerPixelY())
-jump_distance = average_pixel_size * 3
+shared_slope = None
+shared_aspect = None
+shared_elevation = None
 
-min_spacing = average_pixel_size * min_hachure_spacing
-max_spacing = average_pixel_size * max_hachure_spacing
+# Random choices (which of two crowded hachures stops) all come from this
+# generator rather than the random module's, which each window sets up
+# afresh. Nothing else drawing random numbers can then change ours
 
-spacing_range = max_spacing - min_spacing
-slope_range = max_slope - min_slope
+rng = random.Random()
+
+# Which hachures belong to the coarser zoom levels (see LevelsOfDetail).
+# None unless lod_levels is more than 0
+
+lod = None
 
 
 #===========================CLASS DEFINITIONS===========================
 #------Contour lines are used to check the spacing of the hachures------
 class Contour:
-    def __init__(self,contour_geometry,poly_geometry):
+    def __init__(self,contour_geometry,poly_geometry,level):
         self.geometry = contour_geometry
         self.polygon = poly_geometry
+        self.level = level
+        self.prepared_rings = None
+        self.crossings = [] # filled in by split_by_hachures
         
     def ring_list(self):
         # Returns a list of all rings that this contour is made from 
@@ -200,96 +779,940 @@ class Contour:
         else:
             all_rings = [self.geometry]
         return all_rings     
+    
+    def rings(self):
+        # Each ring with its slope profile. These don't depend on the
+        # hachures, so can be worked out ahead of time (see prefetched)
+        if self.prepared_rings is None:
+            self.prepared_rings = [(ring, RingProfile(ring))
+                                   for ring in self.ring_list()]
+        return self.prepared_rings
+    
+    def ring_pieces(self):
+        # Each ring, with its slope profile & the stretch of it to use
+        return [(ring, profile, 0, ring.length())
+                for ring,profile in self.rings()]
         
+    @timed('split_by_hachures')
     def split_by_hachures(self):
         # Split this contour according to our current list of hachures
         all_segments = []
+        
+        # Where each hachure crosses each ring, for the levels of detail
+        self.crossings = []
 
-        for line_geometry in self.ring_list():
+        # Every segment cut from a ring reads its slope from its profile
+        for line_geometry,profile in self.rings():
 
-            intersection_points = []
-            for hachure_feature in current_hachures:
-                hachure_geometry = hachure_feature.geometry()
+            # Only hachures whose bounding boxes overlap this ring can
+            # cross it, so the spatial index narrows down who to check.
+            # A prepared ring then quickly rules out the near misses
+            # before we ask GEOS for the actual intersection points.
+            
+            candidate_ids = hachure_index.intersects(
+                                line_geometry.boundingBox())
+            candidate_ids.sort()
+            
+            engine = QgsGeometry.createGeometryEngine(
+                         line_geometry.constGet())
+            engine.prepareGeometry()
+
+            # Each crossing is kept as plain numbers: where it is, & which
+            # hachure made it
+            xs = []
+            ys = []
+            crossing_ids = []
+            for hachure_id in candidate_ids:
+                hachure_geometry = current_hachures.geometry(hachure_id)
+                if not engine.intersects(hachure_geometry.constGet()):
+                    continue
                 point = line_geometry.intersection(hachure_geometry)
+                count('GEOS intersections')
                 if point.wkbType() == QgsWkbTypes.MultiPoint:
-                    intersection_points += [CutPoint(
-                        QgsGeometry.fromPointXY(p),hachure_feature)
-                        for p in point.asMultiPoint()]
+                    points = point.asMultiPoint()
                 elif point.wkbType() == QgsWkbTypes.Point:
-                    intersection_points += [CutPoint(point, hachure_feature)]
-                # The intersection can return Empty or (rarely) 
-                # a geometryCollection. We can safely skip over these
-            
-            for point in intersection_points:
-                # This tells us where along the line to cut
-                point.cut_location = line_geometry.lineLocatePoint(
-                                         point.geometry)
+                    points = [point.asPoint()]
+                else:
+                    # The intersection can return Empty or (rarely) 
+                    # a geometryCollection. We can safely skip over these
+                    continue
+                for p in points:
+                    xs.append(p.x())
+                    ys.append(p.y())
+                    crossing_ids.append(hachure_id)
+            
+            # This tells us where along the line to cut, for all the
+            # crossings at once
+            cut_locations = profile.locate(xs,ys)
+            
+            if lod is not None:
+                self.crossings.append((line_geometry, profile, [
+                    (location, hachure_id, (x,y)) for location,hachure_id,x,y
+                    in zip(cut_locations.tolist(), crossing_ids, xs, ys)]))
                     
-            if len(intersection_points) > 0:
+            if len(crossing_ids) > 0:
                 # If we found intersections, use them to cut the ring
-                contour_segments = cutpoint_splitter(line_geometry,
-                                                intersection_points)
-                all_segments += contour_segments
+                all_segments.append(ring_splitter(line_geometry,
+                                                  cut_locations,
+                                                  crossing_ids,
+                                                  profile))
             else:
                 # If not, we should still return the unbroken ring
-                ring_feature = QgsFeature()
-                ring_feature.setGeometry(line_geometry)
-                all_segments.append(Segment(ring_feature))
+                all_segments.append(Segments(line_geometry, profile, [0.0],
+                                             [line_geometry.length()]))
             
         return all_segments
     
 #----Segments are contour pieces used to space or generate hachures-----
-class Segment:
-    def __init__(self,segFeature):
-        self.geometry = segFeature.geometry()
-        self.length = self.geometry.length()
-        self.slope = self.slope()
-        self.hachures = []
-        
-        self.status = None
-        # Status stores info on how this segment should affect hachures
-        # These values are used later in subsequent_contour
-        
-        if self.slope < min_slope:
-            self.status = 0
-        elif self.length < (ideal_spacing(self.slope) * 0.9):
-            self.status = 1
-        elif self.length > (ideal_spacing(self.slope) * 2.2):
-            self.status = 2
+class Segments:
+    # There are a great many segments, and most are looked at once and
+    # thrown away. So all of those cut from one ring are kept together as
+    # arrays of where they start & end (measured along the ring), & their
+    # geometry is never cut out
+    
+    __slots__ = ('ring', 'profile', 'starts', 'ends', 'lengths', 'slopes',
+                 'hachures', 'status')
+    
+    def __init__(self,ring,profile,starts,ends,slopes = None,
+                 hachures = None):
+        self.ring = ring
+        self.profile = profile # holds the slope along the whole ring
+        self.starts = np.asarray(starts, dtype = np.float64)
+        self.ends = np.asarray(ends, dtype = np.float64)
+        self.lengths = self.ends - self.starts
+        
+        if slopes is None:
+            with timed('segment slopes'):
+                # Get the average slope under each segment
+                slopes = profile.means(self.starts, self.ends)
+        self.slopes = slopes
+        
+        # The ids of the hachures on either end, or -1 where there's none
+        if hachures is None:
+            hachures = np.full((len(self.starts), 2), -1, dtype = np.int64)
+        self.hachures = hachures
+        
+        # Status stores info on how each segment should affect hachures.
+        # These values are used later in subsequent_contour, & -1 means
+        # the segment is fine as it is
+        spacing = ideal_spacings(slopes)
+        self.status = np.select(
+            [slopes < min_slope, self.lengths < spacing * 0.9,
+             self.lengths > spacing * 2.2],
+            [0, 1, 2], -1)
         # The 0.9 and 2.2 above are thermostat controls. Instead of a
         # line being "too short" when it exactly falls below its ideal
         # spacing, we let it get a little tighter to avoid near-parallel
         # hachures cycling on/off rapidly.
+    
+    def __len__(self):
+        return len(self.starts)
+    
+    def subset(self,rows):
+        return Segments(self.ring, self.profile, self.starts[rows],
+                        self.ends[rows], self.slopes[rows],
+                        self.hachures[rows])
         
-    def ring_list(self):
-        return [self.geometry]
+    def midpoints(self):
+        # Found on the ring itself, so no geometry needs to be cut out
+        return [self.ring.interpolate(middle).asPoint() for middle
+                in (self.starts + self.lengths / 2).tolist()]
+    
+    def split_long(self,limit):
+        # Segments longer than limit are evenly split once more, as their
+        # slope is no longer local. The new pieces are between no
+        # hachures, & everything stays in order along the ring
+        long_rows = np.flatnonzero(self.lengths > limit).tolist()
+        if not long_rows:
+            return self
         
-    def slope(self):
-        # Get the average slope under this segment
-        densified_line = self.geometry.densifyByDistance(average_pixel_size)
-        vertices = [(vertex.x(), vertex.y())
-                    for vertex in densified_line.vertices()]
+        starts,ends,slopes,hachures = [],[],[],[]
+        previous = 0
+        for row in long_rows:
+            starts.append(self.starts[previous:row])
+            ends.append(self.ends[previous:row])
+            slopes.append(self.slopes[previous:row])
+            hachures.append(self.hachures[previous:row])
+            
+            pieces = even_pieces(self.ring, self.profile,
+                                 self.starts[row], self.ends[row])
+            starts.append(pieces.starts)
+            ends.append(pieces.ends)
+            slopes.append(pieces.slopes)
+            hachures.append(pieces.hachures)
+            previous = row + 1
+            
+        starts.append(self.starts[previous:])
+        ends.append(self.ends[previous:])
+        slopes.append(self.slopes[previous:])
+        hachures.append(self.hachures[previous:])
         
-        row_col_coords = [xy_to_rc(c) for c in vertices]
+        return Segments(self.ring, self.profile, np.concatenate(starts),
+                        np.concatenate(ends), np.concatenate(slopes),
+                        np.concatenate(hachures))
+    
+#----RingProfiles hold the slope all along a ring, for fast averaging----
+class RingProfile:
+    @timed('ring profiles')
+    def __init__(self,line_geometry):
+        # Sample the slope every pixel or so along the ring, once
+        densified_line = line_geometry.densifyByDistance(average_pixel_size)
+        xs,ys = vertex_arrays(densified_line)
         
-        samples = [sample_raster(c,0) for c in row_col_coords]
+        samples = sample_many(xs,ys,0)
 
         # if we have null values in the raster, we'll get a nan
         # at this point, bail out. The script isn't designed to
         # handle these
-        nan_check = [a for a in samples if math.isnan(a) is True]
+        if np.isnan(samples).any():
+            raise NullValues()
+        
+        # How far along the ring each sample is, and a running total of
+        # slope × distance up to it (by the trapezoid rule). The mean
+        # slope between any 2 spots is then the difference of the
+        # totals there, divided by the distance between them
+        steps = np.hypot(np.diff(xs), np.diff(ys))
+        self.distance = np.concatenate([[0], np.cumsum(steps)])
+        self.samples = samples
+        self.total = np.concatenate(
+            [[0], np.cumsum(steps * (samples[1:] + samples[:-1]) / 2)])
+        
+        # The ring's own vertices, & how far along it each one is, so
+        # that points on it can be found with array lookups rather than
+        # asking GEOS each time
+        self.xs,self.ys = vertex_arrays(line_geometry)
+        self.along = np.concatenate(
+            [[0], np.cumsum(np.hypot(np.diff(self.xs), np.diff(self.ys)))])
+        self.grid = None
+        
+    def mean(self,start,end):
+        if end - start <= 0:
+            # A single spot rather than a stretch
+            return float(np.interp(start, self.distance, self.samples))
+        
+        start_total,end_total = np.interp([start, end], self.distance,
+                                          self.total)
+        return float((end_total - start_total) / (end - start))
+    
+    def means(self,starts,ends):
+        # The same as mean, for many stretches at once
+        lengths = ends - starts
+        totals = (np.interp(ends, self.distance, self.total) -
+                  np.interp(starts, self.distance, self.total))
+        spots = np.interp(starts, self.distance, self.samples)
+        stretches = lengths > 0
+        return np.where(stretches,
+                        totals / np.where(stretches, lengths, 1), spots)
+    
+    @timed('ring locating')
+    def locate(self,xs,ys):
+        # How far along the ring each point (all lying on it) is, as
+        # lineLocatePoint would say. Each of the ring's segments is
+        # filed under the grid cell its start is in, with cells as wide
+        # as the longest segment. A point on a segment is then in that
+        # segment's cell or one of the 8 around it, so only those few
+        # segments need be tried
+        xs = np.asarray(xs, dtype = np.float64)
+        ys = np.asarray(ys, dtype = np.float64)
+        if len(xs) == 0 or len(self.xs) < 2:
+            return np.zeros(len(xs))
+        
+        if self.grid is None:
+            self.grid = self.segment_grid()
+        cell,x_min,y_min,columns,order,keys = self.grid
         
-        if nan_check != []:
-            warn_user(12)
+        # The 9 cells round each point (cells are numbered from 1, so
+        # the ones round the edge still have numbers of their own)
+        col = np.clip(np.floor((xs - x_min) / cell).astype(np.int64) + 1,
+                      0, columns - 1)
+        row = np.floor((ys - y_min) / cell).astype(np.int64) + 1
+        near = ((row[:,None] + np.repeat([-1, 0, 1], 3)) * columns +
+                col[:,None] + np.tile([-1, 0, 1], 3)).ravel()
+        low = np.searchsorted(keys, near, side = 'left')
+        counts = np.searchsorted(keys, near, side = 'right') - low
+        
+        point_number = np.repeat(np.repeat(np.arange(len(xs)), 9), counts)
+        within = np.arange(counts.sum()) - np.repeat(
+                     np.cumsum(counts) - counts, counts)
+        segment = order[np.repeat(low, counts) + within]
+        
+        # Anything that somehow found no segments tries all of them
+        missed = np.setdiff1d(np.arange(len(xs)), point_number)
+        if len(missed):
+            point_number = np.concatenate(
+                [point_number, np.repeat(missed, len(self.xs) - 1)])
+            segment = np.concatenate(
+                [segment, np.tile(np.arange(len(self.xs) - 1), len(missed))])
+        
+        # Drop each point onto each of its segments, & keep the nearest.
+        # Ties go to the segment that comes first, as in GEOS
+        start_x = self.xs[segment]
+        start_y = self.ys[segment]
+        step_x = self.xs[segment + 1] - start_x
+        step_y = self.ys[segment + 1] - start_y
+        squared = np.maximum(step_x**2 + step_y**2, 1e-300)
+        t = np.clip(((xs[point_number] - start_x) * step_x +
+                     (ys[point_number] - start_y) * step_y) / squared, 0, 1)
+        misses = np.hypot(start_x + t * step_x - xs[point_number],
+                          start_y + t * step_y - ys[point_number])
+        
+        best = np.lexsort((segment, misses, point_number))
+        firsts = best[np.unique(point_number[best], return_index = True)[1]]
+        
+        lengths = np.diff(self.along)
+        return (self.along[segment[firsts]] +
+                t[firsts] * lengths[segment[firsts]])
+    
+    def segment_grid(self):
+        starts_x = self.xs[:-1]
+        starts_y = self.ys[:-1]
+        cell = max(float(np.diff(self.along).max()), 1e-9)
+        x_min = float(self.xs.min())
+        y_min = float(self.ys.min())
+        columns = int((self.xs.max() - x_min) // cell) + 3
+        
+        keys = ((np.floor((starts_y - y_min) / cell).astype(np.int64) + 1) *
+                columns +
+                np.floor((starts_x - x_min) / cell).astype(np.int64) + 1)
+        order = np.argsort(keys, kind = 'stable')
+        
+        return cell,x_min,y_min,columns,order,keys[order]
+    
+#---Raised where the DEM has NULLs; hachure_window reports it (error 12)--
+class NullValues(Exception):
+    pass
+
+#------Windows are the pieces of the DEM that are processed in turn-----
+class Window:
+    def __init__(self,col_off,row_off,width,height,core = None):
+        # Position & size are in DEM pixels
+        self.col_off = col_off
+        self.row_off = row_off
+        self.width = width
+        self.height = height
+        
+        # The core is the part of the window whose hachures we keep; the
+        # rest is overlap with the neighbours. None means keep them all.
+        # It's held as plain (x_min,y_min,x_max,y_max) bounds so windows
+        # can be handed to other processes
+        self.core = core
+        
+    def bounds(self):
+        x_min = dem_extent.xMinimum() + self.col_off * cell_width
+        y_max = dem_extent.yMaximum() - self.row_off * cell_height
+        
+        return (x_min, y_max - self.height * cell_height,
+                x_min + self.width * cell_width, y_max)
+        
+    def extent(self):
+        return QgsRectangle(*self.bounds())
+    
+    def spec(self):
+        # Everything needed to rebuild this window somewhere else
+        return (self.col_off,self.row_off,self.width,self.height,self.core)
+    
+    def is_whole_dem(self):
+        return (self.col_off == 0 and self.row_off == 0 and
+                self.width == dem_cols and self.height == dem_rows)
+                
+    def owns(self,start):
+        # A hachure belongs to the window whose core holds its first
+        # point (None if it has none). Cores share edges, so the right &
+        # bottom are left open
+        if self.core is None:
+            return True
+        
+        if start is None:
+            return False
+        
+        x,y = start
+        x_min,y_min,x_max,y_max = self.core
+        
+        return x_min <= x < x_max and y_min < y <= y_max
+        
+#-----The hachures being worked on, kept as columns of coordinates------
+class HachureStore:
+    # Rather than a QgsFeature for each hachure, every coordinate goes in
+    # one big NumPy buffer, laid out the way GeoArrow lays out lines:
+    # each hachure is a run of parts (haircut can cut one in two), &
+    # each part a run of coordinates. Geometries are only made from
+    # these when something needs one, & then kept until the hachure
+    # changes, as the same ones are asked for contour after contour.
+    #
+    # Hachure ids count up from first_id, so an id's row in the arrays
+    # is just id - first_id. When haircut shortens a hachure its new
+    # coordinates go on the end, & the old ones are tidied away by
+    # compact() once enough have built up.
+    
+    def __init__(self,first_id = 0):
+        self.first_id = first_id
+        self.coords = np.empty((4096, 2))
+        self.coord_count = 0
+        self.part_bounds = np.empty((1024, 2), dtype = np.int64)
+        self.part_count = 0
+        self.hachure_parts = np.empty((1024, 2), dtype = np.int64)
+        self.boxes = np.empty((1024, 4))
+        self.alive = np.zeros(1024, dtype = bool)
+        self.row_count = 0
+        self.live_count = 0
+        self.unused_coords = 0
+        self.geometries = {}
+        
+    def __len__(self):
+        return self.live_count
+    
+    def __contains__(self,hachure_id):
+        row = hachure_id - self.first_id
+        return 0 <= row < self.row_count and self.alive[row]
+    
+    def ids(self):
+        # In the order they were made, as plain Python ints
+        rows = np.flatnonzero(self.alive[:self.row_count])
+        return (rows + self.first_id).tolist()
+    
+    def add(self,hachure_id,parts):
+        # parts is a list of (n,2) coordinate arrays
+        row = hachure_id - self.first_id
+        if row >= len(self.alive):
+            size = max(row + 1, len(self.alive) * 2)
+            self.hachure_parts = grown(self.hachure_parts, size)
+            self.boxes = grown(self.boxes, size)
+            self.alive = grown(self.alive, size)
+        
+        self.row_count = max(self.row_count, row + 1)
+        self.alive[row] = True
+        self.live_count += 1
+        self.geometries.pop(hachure_id, None)
+        self.write_parts(row,parts)
+        
+    def replace(self,hachure_id,parts):
+        row = hachure_id - self.first_id
+        self.unused_coords += self.coords_used(row)
+        self.geometries.pop(hachure_id, None)
+        self.write_parts(row,parts)
+        
+        if (self.unused_coords > 100000 and
+            self.unused_coords > self.coord_count // 2):
+            self.compact()
+    
+    def remove(self,hachure_id):
+        row = hachure_id - self.first_id
+        self.unused_coords += self.coords_used(row)
+        self.alive[row] = False
+        self.live_count -= 1
+        self.geometries.pop(hachure_id, None)
+    
+    def write_parts(self,row,parts):
+        parts = [part for part in parts if len(part) > 0]
+        needed = self.coord_count + sum(len(part) for part in parts)
+        if needed > len(self.coords):
+            self.coords = grown(self.coords, max(needed, len(self.coords)*2))
+        if self.part_count + len(parts) > len(self.part_bounds):
+            self.part_bounds = grown(self.part_bounds,
+                                     len(self.part_bounds) * 2 + len(parts))
+        
+        first_part = self.part_count
+        for part in parts:
+            start = self.coord_count
+            self.coords[start:start + len(part)] = part
+            self.coord_count += len(part)
+            self.part_bounds[self.part_count] = (start, self.coord_count)
+            self.part_count += 1
+        self.hachure_parts[row] = (first_part, self.part_count)
+        
+        if parts:
+            everything = np.concatenate(parts)
+            self.boxes[row,:2] = everything.min(axis = 0)
+            self.boxes[row,2:] = everything.max(axis = 0)
         else:
-            return statistics.fmean(samples)
+            self.boxes[row] = np.nan
+    
+    def coords_used(self,row):
+        first,last = self.hachure_parts[row]
+        bounds = self.part_bounds[first:last]
+        return int((bounds[:,1] - bounds[:,0]).sum())
+    
+    def parts(self,hachure_id):
+        # Views onto the buffer, one (n,2) array per part
+        first,last = self.hachure_parts[hachure_id - self.first_id]
+        return [self.coords[start:end]
+                for start,end in self.part_bounds[first:last]]
+    
+    def start(self,hachure_id):
+        parts = self.parts(hachure_id)
+        if not parts:
+            return None
+        x,y = parts[0][0]
+        return float(x),float(y)
+    
+    def box(self,hachure_id):
+        # A QgsRectangle, or None for a hachure that's been cut away
+        x_min,y_min,x_max,y_max = self.boxes[hachure_id - self.first_id]
+        if np.isnan(x_min):
+            return None
+        return QgsRectangle(x_min,y_min,x_max,y_max)
+    
+    def wkb(self,hachure_id):
+        parts = self.parts(hachure_id)
+        if len(parts) == 1:
+            return line_wkb(parts[0])
+        return (struct.pack('<BII', 1, 5, len(parts)) + # 5 = MultiLineString
+                b''.join(line_wkb(part) for part in parts))
+    
+    def geometry(self,hachure_id):
+        geometry = self.geometries.get(hachure_id)
+        if geometry is None:
+            geometry = QgsGeometry()
+            geometry.fromWkb(self.wkb(hachure_id))
+            self.geometries[hachure_id] = geometry
+        
+        # A shallow copy, which is cheap, so the kept one can't be changed
+        return QgsGeometry(geometry)
+    
+    def outside(self,hachure_ids,box):
+        # Whether each hachure's box lies wholly outside the QgsRectangle
+        x_min,y_min,x_max,y_max = self.boxes[
+            np.asarray(hachure_ids, dtype = np.int64) - self.first_id].T
+        return ((x_min > box.xMaximum()) | (x_max < box.xMinimum()) |
+                (y_min > box.yMaximum()) | (y_max < box.yMinimum()))
+    
+    def features(self,hachure_ids):
+        # Where the hachures leave the store, they become QgsFeatures
+        features = []
+        for hachure_id in hachure_ids:
+            feature = QgsFeature(hachure_id)
+            feature.setGeometry(self.geometry(hachure_id))
+            features.append(feature)
+        return features
+    
+    def vertex_columns(self,hachure_ids):
+        # Every vertex of the given hachures, one after another, & how
+        # many of them belong to each hachure
+        chunks = []
+        counts = []
+        for hachure_id in hachure_ids:
+            parts = self.parts(hachure_id)
+            chunks.extend(parts)
+            counts.append(sum(len(part) for part in parts))
+        if not chunks:
+            return np.empty((0, 2)),np.array(counts, dtype = np.int64)
+        return np.concatenate(chunks),np.array(counts, dtype = np.int64)
+    
+    def compact(self):
+        # Packs the live hachures' coordinates together, in id order,
+        # dropping the ones left behind by replace & remove
+        rows = np.flatnonzero(self.alive[:self.row_count])
+        old_coords = self.coords
+        old_bounds = self.part_bounds
+        old_parts = self.hachure_parts.copy()
+        
+        self.coords = np.empty((max(4096, self.coord_count -
+                                    self.unused_coords), 2))
+        self.part_bounds = np.empty((max(1024, self.part_count), 2),
+                                    dtype = np.int64)
+        self.coord_count = 0
+        self.part_count = 0
+        self.unused_coords = 0
+        
+        for row in rows:
+            first,last = old_parts[row]
+            self.write_parts(row, [old_coords[start:end] for start,end
+                                   in old_bounds[first:last]])
+    
+    def to_geoarrow(self):
+        # The ids, coordinates, part offsets & hachure offsets, as GeoArrow
+        # MultiLineString arrays. The coordinates are the store's own
+        # buffer, not a copy, so they shouldn't be changed
+        self.compact()
+        rows = np.flatnonzero(self.alive[:self.row_count])
+        part_offsets = np.append(self.part_bounds[:self.part_count,0],
+                                 self.coord_count)
+        hachure_offsets = np.append(self.hachure_parts[rows,0],
+                                    self.part_count)
+        return (rows + self.first_id, self.coords[:self.coord_count],
+                part_offsets, hachure_offsets)
+    
+    def add_geoarrow(self,ids,coords,part_offsets,hachure_offsets):
+        # The reverse of to_geoarrow
+        for i,hachure_id in enumerate(ids):
+            parts = [coords[part_offsets[p]:part_offsets[p + 1]] for p in
+                     range(hachure_offsets[i], hachure_offsets[i + 1])]
+            self.add(int(hachure_id), parts)
+    
+    def to_shapely(self):
+        # Shapely 2 can take the GeoArrow arrays as they are
+        import shapely
+        ids,coords,part_offsets,hachure_offsets = self.to_geoarrow()
+        return ids,shapely.from_ragged_array(
+            shapely.GeometryType.MULTILINESTRING, coords,
+            (part_offsets, hachure_offsets))
+
+#----------Copies an array into a bigger one, for appending to----------
+def grown(array,size):
+    bigger = np.zeros((size,) + array.shape[1:], dtype = array.dtype)
+    bigger[:len(array)] = array
+    return bigger
+
+#-------------------WKB for one line of coordinates---------------------
+def line_wkb(coords):
+    # Little-endian (1), LineString (2), then how many points
+    return (struct.pack('<BII', 1, 2, len(coords)) +
+            np.ascontiguousarray(coords, dtype = '<f8').tobytes())
+
+#------------Clippers trim hachures back to a contour's edge------------
+class ContourClipper:
+    # The contour polygon covers everything above the contour & is often
+    # one huge part full of holes, so differencing each hachure against
+    # it (or even against a part of it) is slow. Instead its rings are
+    # cut into short chunks & indexed. A hachure is cut wherever it
+    # crosses the chunks near it, & each piece is kept or dropped by
+    # whether its middle is inside the polygon, which the prepared
+    # polygon can say quickly. So the work for each hachure depends
+    # only on what's near it
+    chunk_size = 200 # vertices
+    
+    def __init__(self,polygon):
+        self.engine = QgsGeometry.createGeometryEngine(polygon.constGet())
+        self.engine.prepareGeometry()
+        
+        self.chunks = []
+        self.chunk_index = QgsSpatialIndex()
+        for part in polygon.asGeometryCollection():
+            shape = part.constGet()
+            rings = [shape.exteriorRing()] + [
+                shape.interiorRing(i)
+                for i in range(shape.numInteriorRings())]
+            for ring in rings:
+                self.add_chunks(ring_coords(ring))
+                
+    def add_chunks(self,coords):
+        # Neighbouring chunks share a vertex, so nothing falls between
+        step = self.chunk_size - 1
+        for first in range(0, max(1, len(coords) - 1), step):
+            chunk = coords[first:first + self.chunk_size]
+            if len(chunk) < 2:
+                continue
+            x_min,y_min = chunk.min(axis = 0)
+            x_max,y_max = chunk.max(axis = 0)
+            self.chunk_index.addFeature(
+                len(self.chunks), QgsRectangle(x_min,y_min,x_max,y_max))
+            self.chunks.append(chunk)
+            
+    def clip(self,hachure_geometry):
+        # Returns the hachure, less whatever falls inside the polygon
+        if not self.engine.intersects(hachure_geometry.constGet()):
+            return hachure_geometry
+        
+        # Pad the box a bit so the hachure sits strictly inside it, even
+        # if it's perfectly straight up & down or side to side
+        box = hachure_geometry.boundingBox()
+        box.grow(average_pixel_size)
+        
+        nearby = [self.chunks[i] for i in self.chunk_index.intersects(box)]
+        edges = QgsGeometry.collectGeometry(
+            [QgsGeometry(QgsLineString(chunk[:,0].tolist(),
+                                       chunk[:,1].tolist()))
+             for chunk in nearby])
+        
+        pieces = []
+        for part in hachure_geometry.asGeometryCollection():
+            pieces += cut_at_crossings(part, edges if nearby else None,
+                                       self.outside)
+        
+        if not pieces:
+            return QgsGeometry(QgsLineString())
+        if len(pieces) == 1:
+            return pieces[0]
+        return QgsGeometry.collectGeometry(pieces)
+    
+    def outside(self,middle):
+        return not self.engine.intersects(middle.constGet())
+
+#-----------A ring's coordinates as an (n,2) array, read from its WKB---
+def ring_coords(ring):
+    wkb = bytes(ring.asWkb())
+    if struct.unpack('<BI', wkb[:5]) == (1, 2):
+        # A little-endian 2D LineString: just the doubles after the count
+        return np.frombuffer(wkb, dtype = '<f8', offset = 9).reshape(-1, 2)
+    
+    return np.column_stack(vertex_arrays(QgsGeometry(ring.clone())))
+
+#----Cuts a line wherever it crosses edges, keeping the pieces wanted----
+def cut_at_crossings(part,edges,keep_piece):
+    # keep_piece is asked about the middle of each piece between two
+    # crossings. With no edges, the whole line is the only piece
+    crossings = None if edges is None else part.intersection(edges)
+    if crossings is None or crossings.isEmpty():
+        cut_locations = []
+    else:
+        cut_locations = sorted(part.lineLocatePoint(QgsGeometry(point))
+            for point in crossings.constGet().vertices())
+    
+    cut_locations = [0] + cut_locations + [part.length()]
+    
+    pieces = []
+    for start,end in zip(cut_locations,cut_locations[1:]):
+        if end <= start:
+            continue
+        piece = QgsGeometry(part.constGet().curveSubstring(start,end))
+        if keep_piece(piece.interpolate(piece.length() / 2)):
+            pieces.append(piece)
     
-#--------------CutPoints mark where a contour is to be cut--------------
-class CutPoint:
-    def __init__(self,point_geometry,hachure_feature):
-        self.geometry = point_geometry
-        self.hachure = hachure_feature
-        self.cut_location = None
+    return pieces
+
+#--Or, they can be trimmed back by the DEM's elevations along them-------
+class RasterClipper:
+    # Hachures climb from lower contours, so what's cut off is whatever
+    # is above this contour's level. Instead of a polygon of all that
+    # ground, we sample the DEM at each vertex & cut where it rises past
+    # the level. If any vertex is too close to the level to be sure,
+    # the hachure is cut where it crosses the contour line instead.
+    def __init__(self,contour):
+        self.contour = contour
+        self.level = contour.level
+        self.margin = contour_interval * 0.1
+        
+    def clip(self,hachure_geometry):
+        pieces = []
+        
+        for part in hachure_geometry.asGeometryCollection():
+            xs,ys = vertex_arrays(part)
+            heights = sample_many(xs,ys,2,bilinear = True) - self.level
+            
+            if np.any(np.abs(heights) < self.margin):
+                count('raster clip fallbacks')
+                pieces += self.cut_at_line(part)
+            else:
+                pieces += self.cut_at_level(xs,ys,heights)
+        
+        if not pieces:
+            return QgsGeometry(QgsLineString())
+        if len(pieces) == 1:
+            return pieces[0]
+        return QgsGeometry.collectGeometry(pieces)
+    
+    def cut_at_level(self,xs,ys,heights):
+        # Keep the runs of vertices below the level, ending each one
+        # where the line between two vertices rises past it
+        pieces = []
+        piece = [(xs[0], ys[0])] if heights[0] < 0 else None
+        
+        for i in range(1,len(xs)):
+            if (heights[i] < 0) != (heights[i-1] < 0):
+                t = heights[i-1] / (heights[i-1] - heights[i])
+                crossing = (xs[i-1] + t * (xs[i] - xs[i-1]),
+                            ys[i-1] + t * (ys[i] - ys[i-1]))
+                if piece is None:
+                    piece = [crossing]
+                else:
+                    piece.append(crossing)
+                    pieces.append(piece)
+                    piece = None
+            if heights[i] < 0:
+                piece.append((xs[i], ys[i]))
+        
+        if piece is not None:
+            pieces.append(piece)
+        
+        return [make_lines(piece).geometry() for piece in pieces
+                if len(piece) > 1]
+    
+    def cut_at_line(self,part):
+        # Only the bit of the contour line near the hachure matters
+        box = part.boundingBox()
+        box.grow(average_pixel_size)
+        nearby_line = self.contour.geometry.clipped(box)
+        
+        # Then keep the pieces between crossings whose middles are low
+        return cut_at_crossings(part,nearby_line,self.below)
+    
+    def below(self,middle):
+        middle = middle.asPoint()
+        height = sample_many([middle.x()],[middle.y()],2,
+                             bilinear = True)[0]
+        return height < self.level
+
+#------Keeps track of which hachures belong to the coarser zooms--------
+class LevelsOfDetail:
+    # Each level zoomed out doubles the spacing. Rather than making the
+    # hachures again for each one, we thin out the ones we're making:
+    # at every contour, the hachures still in a level are checked the
+    # same way subsequent_contour checks them all, & where two are too
+    # close for that level's spacing one of them leaves it. Only the
+    # hachures in a level can be in the next one out, so each level's
+    # hachures are a subset of the last.
+    #
+    # Hachures only ever leave a level part way up, so for each one we
+    # just note how far up it's part of each level: True while it still
+    # is, the (x,y) where it crosses the contour it left at, False if
+    # it never joined, or None if it's yet to be looked at.
+    
+    def __init__(self,levels):
+        self.levels = levels
+        self.reach = {}
+        
+        # Kept apart from rng, so that the hachures themselves come out
+        # the same whether or not levels are being worked out
+        self.rng = random.Random()
+        
+    def check(self,ring_crossings,clipped):
+        # ring_crossings has, for each ring, where along it each hachure
+        # crosses. clipped hachures are ending at this contour anyway
+        clipped = set(clipped)
+        
+        for ring,profile,crossings in ring_crossings:
+            crossings = sorted(crossings)
+            
+            for location,hachure_id,point in crossings:
+                if hachure_id not in self.reach:
+                    self.reach[hachure_id] = [None] * self.levels
+            
+            for level in range(self.levels):
+                self.check_level(level,ring,profile,crossings,clipped)
+    
+    def check_level(self,level,ring,profile,crossings,clipped):
+        spacing_scale = 2 ** (level + 1)
+        closed = ring.constGet().isClosed()
+        length = ring.length()
+        
+        def gap(start,end):
+            # The distance & mean slope from one spot on the ring to the
+            # next, going round past the end of a closed ring if need be
+            if end >= start:
+                return end - start,profile.mean(start,end)
+            first = length - start
+            if first + end <= 0:
+                return 0,profile.mean(start,start)
+            slope = (profile.mean(start,length) * first +
+                     profile.mean(0,end) * end) / (first + end)
+            return first + end,slope
+        
+        def too_close(start,end,thermostat):
+            distance,slope = gap(start,end)
+            spacing = ideal_spacing(slope)
+            if spacing is None:
+                return False
+            return distance < spacing * spacing_scale * thermostat
+        
+        # Those still in this level (bar any stopping here anyway). Just
+        # as in subsequent_contour, one of each pair that's too close
+        # leaves it. 0.9 is the same thermostat the Segments use
+        kept = [c for c in crossings if self.reach[c[1]][level] is True
+                and c[1] not in clipped]
+        pairs = list(zip(kept, kept[1:]))
+        if closed and len(kept) > 1:
+            pairs.append((kept[-1], kept[0]))
+        
+        leaving = {}
+        for (start,id_a,point_a),(end,id_b,point_b) in pairs:
+            if id_a == id_b or not too_close(start,end,0.9):
+                continue
+            pair = [(id_a,point_a), (id_b,point_b)]
+            self.rng.shuffle(pair)
+            hachure_id,point = pair[0]
+            leaving.setdefault(hachure_id, point)
+        
+        # Leaving a level means leaving all the ones further out too
+        for hachure_id,point in sorted(leaving.items()):
+            reach = self.reach[hachure_id]
+            for outer in range(level, self.levels):
+                if reach[outer] is True:
+                    reach[outer] = point
+        
+        # Then hachures seen for the first time at this level may join
+        # it, if there's room for them either side. They're taken in
+        # turn along the ring, so each one makes room for the next
+        locations = [c[0] for c in kept if c[1] not in leaving]
+        for location,hachure_id,point in crossings:
+            reach = self.reach[hachure_id]
+            if reach[level] is not None:
+                continue
+            if hachure_id in clipped or (level > 0 and
+                                         reach[level - 1] is not True):
+                reach[level] = False
+                continue
+            
+            after = bisect.bisect(locations, location)
+            if after < len(locations):
+                next_location = locations[after]
+            elif closed and locations:
+                next_location = locations[0]
+            else:
+                next_location = None
+            if after > 0:
+                last_location = locations[after - 1]
+            elif closed and locations:
+                last_location = locations[-1]
+            else:
+                last_location = None
+            
+            crowded = ((next_location is not None and
+                        too_close(location,next_location,1)) or
+                       (last_location is not None and
+                        too_close(last_location,location,1)))
+            
+            # Anything that doesn't get in now stays out for good
+            reach[level] = not crowded
+            if not crowded:
+                locations.insert(after, location)
+                
+    def distances(self,hachure_id,parts):
+        # How far along its (finished) parts the hachure stays in each
+        # level. Only asked once, as the hachure leaves the window
+        reach = self.reach.pop(hachure_id, [None] * self.levels)
+        total = float(sum(np.hypot(*np.diff(part, axis = 0).T).sum()
+                          for part in parts))
+        
+        distances = []
+        for level,point in enumerate(reach):
+            if point is True:
+                distance = total
+            elif point is None or point is False:
+                distance = 0.0
+            else:
+                distance = distance_along(parts,point)
+            if level > 0:
+                distance = min(distance, distances[-1])
+            distances.append(distance)
+            
+        return distances
+    
+    def state(self):
+        return self.reach,self.rng.getstate()
+        
+    def restore(self,state):
+        self.reach,rng_state = state
+        self.rng.setstate(rng_state)
+
+#----------How far along a multi-part line a point on it lies-----------
+def distance_along(parts,point):
+    # The point is dropped onto every segment of every part at once, &
+    # the nearest one is where it lies
+    px,py = point
+    best = None
+    offset = 0.0
+    
+    for part in parts:
+        starts = part[:-1]
+        steps = np.diff(part, axis = 0)
+        lengths = np.hypot(steps[:,0], steps[:,1])
+        if len(lengths) == 0:
+            continue
+        
+        squared = np.maximum(lengths ** 2, 1e-300)
+        t = np.clip(((px - starts[:,0]) * steps[:,0] +
+                     (py - starts[:,1]) * steps[:,1]) / squared, 0, 1)
+        misses = np.hypot(starts[:,0] + t * steps[:,0] - px,
+                          starts[:,1] + t * steps[:,1] - py)
+        
+        nearest = int(np.argmin(misses))
+        if best is None or misses[nearest] < best[0]:
+            along = (offset + lengths[:nearest].sum() +
+                     t[nearest] * lengths[nearest])
+            best = (misses[nearest], float(along))
+        offset += lengths.sum()
+    
+    return 0.0 if best is None else best[1]
 
 #=========================FUNCTION DEFINITIONS-=========================
 #--------Converts x/y coords to row/col for sampling the rasters--------
@@ -305,14 +1728,77 @@ def xy_to_rc(location):
 def sample_raster(location,type = 0):
     row,col = location
     
+    count('raster samples')
+    
     if row >= rows or col >= cols or row < 0 or col < 0:
         # i.e., if we're out of bounds
         return 0
     
     if type == 0:
-        return slope_block.value(row,col)
+        return float(slope_array[row,col])
     else:
-        return aspect_block.value(row,col)
+        return float(aspect_array[row,col])
+
+#-----Samples the slope or aspect raster at many x/y coords at once-----
+def sample_many(xs,ys,type = 0,bilinear = False):
+    # Same rules as xy_to_rc & sample_raster, but for whole arrays.
+    # NumPy's rounding matches Python's round() (halves go to even)
+    xs = np.asarray(xs, dtype = np.float64)
+    ys = np.asarray(ys, dtype = np.float64)
+    count('raster samples', len(xs))
+    
+    col_position = (xs - extent.xMinimum()) / cell_width - 0.5
+    row_position = (extent.yMaximum() - ys) / cell_height - 0.5
+    cols_idx = np.round(col_position).astype(np.int64)
+    rows_idx = np.round(row_position).astype(np.int64)
+    
+    inside = ((rows_idx >= 0) & (rows_idx < rows) &
+              (cols_idx >= 0) & (cols_idx < cols))
+    
+    # 0 = slope, 1 = aspect, 2 = elevation
+    array = (slope_array, aspect_array, elevation_array)[type]
+    
+    # Anything out of bounds comes back as 0, just like sample_raster
+    samples = np.zeros(len(xs))
+    
+    if not bilinear:
+        samples[inside] = array[rows_idx[inside], cols_idx[inside]]
+        return samples
+    
+    # Otherwise blend the 4 cells around each point by how close it is
+    # to their centres. Points on the outer half-cell use the edge value
+    col_position = np.clip(col_position[inside], 0, cols - 1)
+    row_position = np.clip(row_position[inside], 0, rows - 1)
+    
+    left = np.minimum(np.floor(col_position).astype(np.int64), cols - 2)
+    top = np.minimum(np.floor(row_position).astype(np.int64), rows - 2)
+    left = np.maximum(left, 0)
+    top = np.maximum(top, 0)
+    right = np.minimum(left + 1, cols - 1)
+    bottom = np.minimum(top + 1, rows - 1)
+    
+    across = col_position - left
+    down = row_position - top
+    
+    upper = (array[top,left] * (1 - across) + array[top,right] * across)
+    lower = (array[bottom,left] * (1 - across) +
+             array[bottom,right] * across)
+    samples[inside] = upper * (1 - down) + lower * down
+    
+    return samples
+
+#-------Pulls the vertices of a line geometry out as 2 NumPy arrays-----
+def vertex_arrays(line_geometry):
+    line = line_geometry.constGet()
+    
+    if isinstance(line, QgsLineString):
+        return np.array(line.xVector()), np.array(line.yVector())
+    
+    # Multipart or curved lines take the slower road
+    vertices = [(vertex.x(), vertex.y())
+                for vertex in line_geometry.vertices()]
+    coords = np.array(vertices, dtype = np.float64).reshape(-1, 2)
+    return coords[:,0], coords[:,1]
         
 #-----------Given a slope, find the ideal spacing of hachures-----------
 def ideal_spacing(slope):
@@ -331,68 +1817,85 @@ def ideal_spacing(slope):
     
     return spacing
     
+#------------The same as ideal_spacing, for many slopes at once---------
+def ideal_spacings(slopes):
+    # Slopes too shallow for hachures get a spacing too, so check those
+    # against min_slope first
+    slope_pct = (np.minimum(slopes, max_slope) - min_slope) / slope_range
+    spacing_qty = slope_pct * spacing_range
+    
+    return max_spacing - spacing_qty
+    
 #--Take Segments & turn them into dashed lines based on ideal spacing---
 def dash_maker(contour_segment_list):
     
     output_segments = []
     
-    for contour_segment in contour_segment_list:
-        slope = contour_segment.slope
-        if slope < min_slope:
-            continue
-                
-        spacing = ideal_spacing(slope)
-        
-        #We tune the spacing value based on the segment length to ensure
-        #an integer number of dashes. This is rather like the automatic
-        #dash/gap spacing in Adobe Illustrator
-
-        #Our goal here is to split a segment into dashes & gaps, thusly:
-        #  ----    ----    ----    ----    ----    ----    ----
-        #Each dash length = spacing, surrounded by gaps half that width
-        #Thus one unit looks like this: |  ----  |
+    for ring_segments in contour_segment_list:
+        # Dashes are just stretches of the same ring, further along
+        dash_starts = []
+        dash_ends = []
         
-        total_length = spacing * 2 #the length of a gap + dash + gap
-        total_units = round(contour_segment.length / total_length)
-        
-        if total_units == 0:
-            #Just in case we round down to the point of having 0 dashes
-            continue
-        
-        dash_gap_length = contour_segment.length / total_units
-
-        dash_width = dash_gap_length / 2
-        #half of our gap-dash-gap is the dash
+        for offset,length,slope in zip(ring_segments.starts.tolist(),
+                                       ring_segments.lengths.tolist(),
+                                       ring_segments.slopes.tolist()):
+            if slope < min_slope:
+                continue
+            
+            add_dashes(dash_starts,dash_ends,offset,length,slope)
+            
+        if dash_starts:
+            output_segments.append(Segments(ring_segments.ring,
+                                            ring_segments.profile,
+                                            dash_starts, dash_ends))
 
-        gap_width = dash_width / 2
-        start_point = gap_width
-        end_point = dash_width + gap_width
+    if len(output_segments) > 0:       
+        return output_segments
+        
+    else:
+        return None 
 
-        geometry = contour_segment.geometry
+#---------Adds the dashes for one segment onto the lists given----------
+def add_dashes(dash_starts,dash_ends,offset,length,slope):
+    spacing = ideal_spacing(slope)
+    
+    #We tune the spacing value based on the segment length to ensure
+    #an integer number of dashes. This is rather like the automatic
+    #dash/gap spacing in Adobe Illustrator
+
+    #Our goal here is to split a segment into dashes & gaps, thusly:
+    #  ----    ----    ----    ----    ----    ----    ----
+    #Each dash length = spacing, surrounded by gaps half that width
+    #Thus one unit looks like this: |  ----  |
+    
+    total_length = spacing * 2 #the length of a gap + dash + gap
+    total_units = round(length / total_length)
+    
+    if total_units == 0:
+        #Just in case we round down to the point of having 0 dashes
+        return
+    
+    dash_gap_length = length / total_units
 
-        while True:
-            substring_feature = QgsFeature()
-            line_substring = geometry.constGet().curveSubstring(
-                start_point, end_point)
-            substring_feature.setGeometry(line_substring)
+    dash_width = dash_gap_length / 2
+    #half of our gap-dash-gap is the dash
 
-            output_segments.append(Segment(substring_feature))
+    gap_width = dash_width / 2
+    start_point = gap_width
+    end_point = dash_width + gap_width
 
-            start_point += dash_gap_length
-            end_point += dash_gap_length
+    while True:
+        dash_starts.append(offset + start_point)
+        dash_ends.append(offset + end_point)
 
-            if end_point > contour_segment.length:
-               break
+        start_point += dash_gap_length
+        end_point += dash_gap_length
 
-    if len(output_segments) > 0:       
-        return output_segments
-        
-    else:
-        return None 
+        if end_point > length:
+           break
          
 #-------------------Starts our first set of hachures--------------------
 def first_contour(contour):
-    global current_hachures
             
     # Split the contour into even segments to begin
     contour_segments = even_splitter(contour)
@@ -401,11 +1904,10 @@ def first_contour(contour):
     dashes = dash_maker(contour_segments)
     
     if dashes:
-        current_hachures = hachure_generator(dashes)
+        hachure_generator(dashes)
     
 #----Checks a contour to see where hachures need to be trimmed/begun----
 def subsequent_contour(contour):
-    global current_hachures
 
     # First we split the contour according to the existing hachures
     
@@ -414,44 +1916,37 @@ def subsequent_contour(contour):
     # We may need to further subdivide some of these. Some segments may
     # be too long & their slope calculations are no longer local
     
-    segment_list = []
-    
-    for segment in split_contour:
-        if segment.length > max_spacing * 3:
-            segment_list += even_splitter(segment)
-        else:
-            segment_list += [segment]
+    segment_list = [ring_segments.split_long(max_spacing * 3)
+                    for ring_segments in split_contour]
 
     too_short = []
     too_long = []
     clip_all = []
 
-    for segment in segment_list:
-    
-        if segment.status == 1:
-            too_short.append(segment)
-        elif segment.status == 2:
-            too_long.append(segment)
-        elif segment.status == 0:
-            clip_all.append(segment)
+    # Each ring's segments are sorted by their status all at once
+    for ring_segments in segment_list:
+        
+        too_short.append(ring_segments.subset(ring_segments.status == 1))
+        too_long.append(ring_segments.subset(ring_segments.status == 2))
+        clip_all.append(ring_segments.subset(ring_segments.status == 0))
 
     # too_short: this segment spans 2 hachures that are too close
     # too_long: segment's 2 hachures are too far apart
     # clip_all: this segment's slope is low enough that hachures stop
   
 
-    # We first find which hachures must be clipped off
+    # We first find which hachures must be clipped off. These are ids,
+    # so we can look them straight up in current_hachures
     
     to_clip = []
     
     for seg in clip_all:
-        to_clip.extend(seg.hachures)
+        to_clip.extend(seg.hachures[seg.hachures >= 0].tolist())
 
     for seg in too_short:
-        hachures = seg.hachures
-        if len(hachures) == 2:
-            # Some segments won't touch enough hachures
-            random.shuffle(hachures)
+        # Some segments won't touch enough hachures
+        for hachures in seg.hachures[seg.hachures[:,0] >= 0].tolist():
+            rng.shuffle(hachures)
             
             to_clip.append(hachures[0])
 
@@ -459,118 +1954,230 @@ def subsequent_contour(contour):
     # on each side, and both of them choose that particular hachure as
     # the 1 that needs to be clipped off. So we remove duplicates:
     
-    to_clip = list(set(to_clip))
+    to_clip = sorted(set(to_clip))
     
-    # Remove those to be clipped from the current hachures
-    current_hachures = [f for f in current_hachures if f not in to_clip]
-
-    # Clip them, then put them back
-    clipped_hachures = haircut(contour,to_clip)
-    current_hachures += clipped_hachures
+    # The coarser zoom levels are thinned out at the same time
+    if lod is not None:
+        lod.check(contour.crossings,to_clip)
+    
+    # Clip them; each one is swapped in place for its clipped version
+    haircut(contour,to_clip)
     
     #Let's next deal with adding new hachures to the too_long segments
     
-    made_additions = False
-    if len(too_long) > 0:
+    if sum(len(seg) for seg in too_long) > 0:
         
         dashes = dash_maker(too_long)
   
         if dashes: #this could come back with None so we must check
-            made_additions = True
-            additions = hachure_generator(dashes)
-    
-    if made_additions:
-        current_hachures += additions
+            hachure_generator(dashes)
 
 #----Clips off hachures that need to stop at this particular contour----
-def haircut(contour,hachure_list):
+@timed('haircut')
+def haircut(contour,hachure_ids):
     
-    contour_poly_geometry = contour.polygon
+    if not hachure_ids:
+        return
     
-    clipped = []
-    for hachure in hachure_list:
-        hachure_geo = hachure.geometry()
-        feat = QgsFeature()
-        feat.setGeometry(hachure_geo.difference(contour_poly_geometry))
-        clipped.append(feat)
-  
-    return clipped
+    if raster_clipping:
+        clipper = RasterClipper(contour)
+    else:
+        clipper = ContourClipper(contour.polygon)
+    
+    count('hachures clipped', len(hachure_ids))
+    
+    for hachure_id in hachure_ids:
+        hachure_geo = current_hachures.geometry(hachure_id)
+        replace_hachure(hachure_id,clipper.clip(hachure_geo))
 
 #--Generates new hachures starting at the middle of any given segment---
+@timed('hachure_generator')
 def hachure_generator(segment_list):
 
     #First we need the midpoint in each line, to begin our hachure from  
     start_points = []
     
-    for segment in segment_list:
+    for ring_segments in segment_list:
+        
+        start_points.extend(ring_segments.midpoints())
+    
+    #Next trace the hachures downhill from those start_points
+    
+    if vectorized_tracing:
+        traced_lines = trace_hachures(start_points)
+    else:
+        traced_lines = [trace_hachure(coords) for coords in start_points]
+    
+    for line_coords in traced_lines:
+        if len(line_coords) > 1:
+            # if we stopped before we even got 2 points, don't bother
+            add_hachure(line_coords)
+
+#---------Traces a single hachure downhill from its starting point------
+def trace_hachure(coords):
+    line_coords = [coords]
+    
+    x,y = coords
+    rc = xy_to_rc(coords)
+    value = sample_raster(rc,1) # 1= Get the aspect value
+    
+    if value == 0: #if we go out of bounds, stop this line
+        return []
+    
+    #And here I try to recall 11th-grade trigonometry 
+    
+    new_x = x - math.sin(math.radians(value)) * jump_distance
+    new_y = y - math.cos(math.radians(value)) * jump_distance
+    
+    line_coords += [(new_x,new_y)]
+    
+    for i in range(0,150):
+        # this loop is a failsafe in case other checks below fail
+        # to stop the hachure when they should
         
-        midpoint = segment.length / 2
+        x,y = line_coords[-1]
+        rc = xy_to_rc(line_coords[-1])
+        value = sample_raster(rc,1) #get the aspect value
+        slope = sample_raster(rc,0) #the slope, too
+        if value == 0: # we're out of bounds of the raster
+            del line_coords[-1]
+            break
         
-        midpoint = segment.geometry.interpolate(midpoint)        
+        if slope < min_slope:
+            #if we hit shallow slopes, lines should end
+            del line_coords[-1]
+            break
+            
+        value += 180
+        new_x = x + math.sin(math.radians(value)) * jump_distance
+        new_y = y + math.cos(math.radians(value)) * jump_distance
+            
+        # Hachures often bounce back and forth in shallow slopes &
+        # should stop. If lines are zig-zagging, every other point
+        # will be separated by only a small distance
+
+        if (len(line_coords) > 3 and
+            dist(line_coords[-1], line_coords[-3])
+            < (jump_distance * 1.5)):
+            
+        # Snip off the last couple points if we've gone bad:
+            del line_coords[-2:]
+            break
+
+        line_coords += [(new_x,new_y)]
         
-        start_points.append(midpoint.asPoint())
+    return line_coords
+
+#------Traces many hachures at once, stepping all of them together------
+def trace_hachures(start_points):
+    # This follows exactly the same rules as trace_hachure, but every
+    # line takes its next step at the same time, so each step is a
+    # handful of array operations rather than a Python loop per line
     
-    #Next loop through the start_points & make hachures
+    if len(start_points) == 0:
+        return []
     
-    feature_list = []
+    starts = np.array([(p[0], p[1]) for p in start_points], dtype=np.float64)
+    count = len(starts)
     
-    for coords in start_points:
-        line_coords = [coords]
-        
-        x,y = coords
-        rc = xy_to_rc(coords)
-        value = sample_raster(rc,1) # 1= Get the aspect value
+    # Each line holds its start, its first step & up to 150 more points.
+    # lengths says how many of those points each line is actually using
+    coords = np.zeros((count, 152, 2))
+    lengths = np.zeros(count, dtype=np.int64)
+    coords[:,0] = starts
+    
+    value = sample_many(starts[:,0], starts[:,1], 1)
+    
+    # Lines starting out of bounds are dropped, i.e., left with 0 points
+    active = value != 0
+    lengths[active] = 2
+    
+    radians = np.radians(value)
+    coords[:,1,0] = starts[:,0] - np.sin(radians) * jump_distance
+    coords[:,1,1] = starts[:,1] - np.cos(radians) * jump_distance
+    
+    for i in range(0,150):
+        live = np.flatnonzero(active)
+        if len(live) == 0:
+            break
         
-        if value == 0: #if we go out of bounds, stop this line
-            continue
+        # Every line still going has the same number of points: i + 2
+        n = i + 2
+        x = coords[live,n - 1,0]
+        y = coords[live,n - 1,1]
+        value = sample_many(x, y, 1)
+        slope = sample_many(x, y, 0)
         
-        #And here I try to recall 11th-grade trigonometry 
+        # Out of bounds or too shallow: drop the last point & stop
+        stopped = (value == 0) | (slope < min_slope)
+        lengths[live[stopped]] -= 1
+        active[live[stopped]] = False
         
-        new_x = x - math.sin(math.radians(value)) * jump_distance
-        new_y = y - math.cos(math.radians(value)) * jump_distance
+        going = ~stopped
+        live, x, y, value = live[going], x[going], y[going], value[going]
         
-        line_coords += [(new_x,new_y)]
+        value += 180
+        new_x = x + np.sin(np.radians(value)) * jump_distance
+        new_y = y + np.cos(np.radians(value)) * jump_distance
         
-        for i in range(0,150):
-            # this loop is a failsafe in case other checks below fail
-            # to stop the hachure when they should
+        # The zig-zag check, which only applies once a line has 4 points
+        if n > 3:
+            back_x = coords[live,n - 3,0]
+            back_y = coords[live,n - 3,1]
+            gap = np.sqrt((x - back_x)**2 + (y - back_y)**2)
+            zigzag = gap < (jump_distance * 1.5)
+            lengths[live[zigzag]] -= 2
+            active[live[zigzag]] = False
             
-            x,y = line_coords[-1]
-            rc = xy_to_rc(line_coords[-1])
-            value = sample_raster(rc,1) #get the aspect value
-            slope = sample_raster(rc,0) #the slope, too
-            if value == 0: # we're out of bounds of the raster
-                del line_coords[-1]
-                break
-            
-            if slope < min_slope:
-                #if we hit shallow slopes, lines should end
-                del line_coords[-1]
-                break
-                
-            value += 180
-            new_x = x + math.sin(math.radians(value)) * jump_distance
-            new_y = y + math.cos(math.radians(value)) * jump_distance
-                
-            # Hachures often bounce back and forth in shallow slopes &
-            # should stop. If lines are zig-zagging, every other point
-            # will be separated by only a small distance
-
-            if (len(line_coords) > 3 and
-                dist(line_coords[-1], line_coords[-3])
-                < (jump_distance * 1.5)):
-                
-            # Snip off the last couple points if we've gone bad:
-                del line_coords[-2:]
-                break
+            going = ~zigzag
+            live, new_x, new_y = live[going], new_x[going], new_y[going]
+        
+        coords[live,n,0] = new_x
+        coords[live,n,1] = new_y
+        lengths[live] += 1
+    
+    return [[(float(x), float(y)) for x, y in coords[k,:lengths[k]]]
+            for k in range(count)]
 
-            line_coords += [(new_x,new_y)]
-            
-        if len(line_coords) > 1:
-            # if we stopped before we even got 2 points, don't bother
-            feature_list.append(make_lines(line_coords))
+#---Adds to current_hachures, keeping the spatial index in step with it---
+def add_hachure(line_coords):
+    global next_hachure_id
+    
+    # Each hachure gets a unique id, which is how everything else refers
+    # to it. The spatial index hands back these same ids
+    hachure_id = next_hachure_id
+    next_hachure_id += 1
     
-    return feature_list
+    current_hachures.add(hachure_id, [np.asarray(line_coords, dtype = float)])
+    index_hachure(hachure_id)
+    count('hachures created')
+
+#-------Swaps a hachure for a new version of itself, under the same id----
+def replace_hachure(hachure_id,geometry):
+    unindex_hachure(hachure_id)
+    parts = [np.column_stack(vertex_arrays(part))
+             for part in geometry.asGeometryCollection()]
+    current_hachures.replace(hachure_id, parts)
+    index_hachure(hachure_id)
+
+#-----------Takes a hachure out of current_hachures altogether----------
+def remove_hachure(hachure_id):
+    unindex_hachure(hachure_id)
+    current_hachures.remove(hachure_id)
+
+#------The spatial index only needs each hachure's id & bounding box-----
+def index_hachure(hachure_id):
+    box = current_hachures.box(hachure_id)
+    if box is not None: # Hachures cut away to nothing aren't indexed
+        hachure_index.addFeature(hachure_id, box)
+
+def unindex_hachure(hachure_id):
+    # The index finds what to delete by its bounding box
+    box = current_hachures.box(hachure_id)
+    if box is not None:
+        entry = QgsFeature(hachure_id)
+        entry.setGeometry(QgsGeometry.fromRect(box))
+        hachure_index.deleteFeature(entry)
 
 #---------------------Cartesian distance calculator---------------------    
 def dist(one,two):
@@ -590,207 +2197,862 @@ def make_lines(coord_list):
 
 #-----Splits a line feature into even segments based on max_spacing-----
 def even_splitter(contour):
-    spacing = max_spacing * 3 
     output_segments = []
         
-    for line_geometry in contour.ring_list():
-        
-        length = line_geometry.length()
-        start_point = 0
-        end_point = spacing
-        
-        i = spacing
-        cut_locations = []
-        while i < length:
-            cut_locations.append(i)
-            i += spacing
-            
-        output_segments.extend(master_splitter(line_geometry,cut_locations))
+    for ring,profile,start,end in contour.ring_pieces():
+        output_segments.append(even_pieces(ring,profile,start,end))
 
     return output_segments
 
-#---Takes a single line geometry and splits it at a list of locations---
-def master_splitter(line_geometry,cut_locations):
-    start_point = 0
-    cut_locations.append(line_geometry.length())
-    cut_locations.sort()
-    
-    segment_list = []
+#----Splits a stretch of a ring into even pieces, max_spacing * 3 long--
+def even_pieces(ring,profile,start,end):
+    spacing = max_spacing * 3 
     
-    for cut_spot in cut_locations:
-        
-        line_substring = line_geometry.constGet().curveSubstring(
-                             start_point,cut_spot)
-        new_feature = QgsFeature()
-        new_feature.setGeometry(line_substring)
-        segment_list.append(Segment(new_feature))
-        start_point = cut_spot
+    # Cut locations are measured along the whole ring
+    i = start + spacing
+    cut_locations = []
+    while i < end:
+        cut_locations.append(i)
+        i += spacing
         
-    return segment_list
+    return master_splitter(ring,cut_locations,profile,start,end)
 
-#---Like master_splitter, but uses CutPoints instead of cut locations---
-def cutpoint_splitter(line_geometry,CutPoint_list):
-    CutPoint_list.sort(key = lambda x: x.cut_location)
+#---Takes a stretch of a ring and splits it at a list of locations------
+def master_splitter(ring,cut_locations,profile,start_point,end_point):
+    cut_spots = np.sort(np.append(cut_locations, end_point))
+    starts = np.concatenate([[start_point], cut_spots[:-1]])
     
-    # CutPoints hold info on what hachure generated them; we want to add
-    # that info to the subsequent segments
+    return Segments(ring,profile,starts,cut_spots)
+
+#----Splits a whole ring where hachures cross it, keeping their ids------
+@timed('ring splitting')
+def ring_splitter(ring,cut_locations,hachure_ids,profile):
+    # Sorted along the ring. Crossings in the same spot stay in the
+    # order they came in
+    order = np.argsort(cut_locations, kind = 'stable')
+    cut_locations = np.asarray(cut_locations)[order]
+    hachure_ids = np.asarray(hachure_ids, dtype = np.int64)[order]
     
-    segment_list = []
+    # One segment up to the first cut, one between each pair of cuts, &
+    # one from the last cut to the end of the ring
+    starts = np.concatenate([[0], cut_locations])
+    ends = np.concatenate([cut_locations, [ring.length()]])
     
-    # Add first segment
-    line_substring = line_geometry.constGet().curveSubstring(
-                         0,CutPoint_list[0].cut_location)
-    new_feature = QgsFeature()
-    new_feature.setGeometry(line_substring)
-    segment_list.append(Segment(new_feature))
-
-    # Then do all the middle cuts & append hachure data to the Segments
-    for i in range(0,len(CutPoint_list)):
-        start_point = CutPoint_list[i]
-        start_location = start_point.cut_location
-        if i == len(CutPoint_list) - 1:
-            # Checks if we're at end of the list & handles final segment
-            end_location = line_geometry.length()
-        else:
-            end_point = CutPoint_list[i+1]
-            end_location = end_point.cut_location
-        line_substring = line_geometry.constGet().curveSubstring(
-                             start_location,end_location)
-        new_feature = QgsFeature()
-        new_feature.setGeometry(line_substring)
-        new_segment = Segment(new_feature)
-        segment_list.append(new_segment)
-        if i != len(CutPoint_list) - 1:
-            new_segment.hachures = [start_point.hachure,end_point.hachure]
-            
-    return segment_list
+    # The segments in between know which hachures they lie between
+    hachures = np.full((len(starts), 2), -1, dtype = np.int64)
+    hachures[1:-1,0] = hachure_ids[:-1]
+    hachures[1:-1,1] = hachure_ids[1:]
+        
+    return Segments(ring,profile,starts,ends,hachures = hachures)
 
 #===============FUNCTIONS OVER; BEGIN CONTOUR PREPARATION===============
-#-STEP 1: Process the contours so that they are all in the needed format
-
-instance.addMapLayer(filled_contours,False)
-# Add filled_contours as hidden layer so I can work with it below
-
-# First we sort the contours from low elevation to high.
-# They probably were already sorted this way, but let's not chance it.
+#-----STEP 1: Make the contours for a window of the DEM, in memory------
+def window_contours(window):
+    # GDAL's contour generator runs in this process & writes to layers
+    # held in memory, so there's nothing to write to disk & read back.
+    # Lines & polygons are made from the same elevations at the same
+    # levels, so the polygons' edges lie exactly along the lines.
+    dataset = gdal.Open(dem_path)
+    
+    if not window.is_whole_dem():
+        # A VRT held in memory lets GDAL see just this window of the DEM
+        dataset = gdal.Translate('', dataset, format = 'VRT',
+                                 srcWin = [window.col_off, window.row_off,
+                                           window.width, window.height])
+    band = dataset.GetRasterBand(1)
+    
+    # Unlike gdal_contour, the contour generator only skips the band's
+    # no-data cells if it's told to
+    options = [f'LEVEL_INTERVAL={contour_interval}']
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        options.append(f'NODATA={nodata!r}')
+    
+    memory = ogr.GetDriverByName('Memory').CreateDataSource('')
+    
+    with timed('contours (GDAL)'):
+        # Bands between one level & the next, as polygons. Clipping by
+        # raster doesn't need these at all
+        polygon_layer = memory.CreateLayer(
+            'polygons', geom_type = ogr.wkbMultiPolygon)
+        polygon_layer.CreateField(ogr.FieldDefn('ELEV_MIN', ogr.OFTReal))
+        polygon_layer.CreateField(ogr.FieldDefn('ELEV_MAX', ogr.OFTReal))
+        if not raster_clipping:
+            gdal.ContourGenerateEx(band, polygon_layer, options = options + [
+                'POLYGONIZE=YES', 'ELEV_FIELD_MIN=0', 'ELEV_FIELD_MAX=1'])
+        
+        # & the contour lines themselves
+        line_layer = memory.CreateLayer(
+            'lines', geom_type = ogr.wkbLineString)
+        line_layer.CreateField(ogr.FieldDefn('ELEV', ogr.OFTReal))
+        gdal.ContourGenerateEx(band, line_layer, options = options + [
+            'ELEV_FIELD=0'])
+    
+    # Both are kept as WKB, keyed by level, & only made into geometries
+    # once the main loop reaches them. A band is keyed by its top level,
+    # which is the level of the contour line running round its top edge
+    bands = {}
+    for feature in polygon_layer:
+        bands[feature.GetField(1)] = bytes(
+            feature.GetGeometryRef().ExportToIsoWkb())
+    
+    lines = defaultdict(list)
+    for feature in line_layer:
+        lines[feature.GetField(0)].append(bytes(
+            feature.GetGeometryRef().ExportToIsoWkb()))
+    
+    return bands,lines
+
+#-----Gets the next few contours ready while the main loop is busy------
+def prefetched(contours,depth):
+    # A second thread runs the contour stream up to depth contours ahead
+    # of the main loop, working out each one's polygon, rings & slope
+    # profiles, none of which depend on the hachures. Only one thread
+    # ever moves the stream along, so the contours stay in order.
+    # Timings & counters are shared by both threads, so a stage timed in
+    # each overlaps with the other
+    if depth <= 0:
+        yield from contours
+        return
+    
+    def prepare_next():
+        contour = next(contours, None)
+        if contour is not None:
+            contour.rings()
+        return contour
+    
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque(executor.submit(prepare_next)
+                        for i in range(depth))
+        while True:
+            # Any error in the thread is raised again here, by result()
+            contour = pending.popleft().result()
+            if contour is None:
+                break
+            pending.append(executor.submit(prepare_next))
+            yield contour
 
-contour_polys = [f for f in filled_contours.getFeatures()]
-contour_polys.sort(key = lambda x: x.attributeMap()['ELEV_MIN'])
+#-----Turns WKB from window_contours back into a QGIS geometry----------
+def wkb_geometry(wkb):
+    geometry = QgsGeometry()
+    geometry.fromWkb(wkb)
+    return geometry
 
 # Each contour poly will be turned into a new polygon showing all areas
-# that are *higher* than that contour
-
-#-----STEP 2: Make a simple rectangle poly covering contours' extent----
-extent = filled_contours.extent()
-boundary_polygon = QgsGeometry.fromRect(extent)
-
-#--STEP 3: Iterate through each contour poly and subtract it from our---
-#------rectangle, thus yielding rectangles with varying size holes------
-
-contour_geometries = [f.geometry() for f in contour_polys]
-
-# Loop below starts with our boundary rectangle, subtracts the lowest
-# elevation poly from it, and stores the result. It then subtracts the
-# 2nd-lowest poly from that result and stores that. And so on, each time
-# subtracting the next-lowest poly from the result of the last operation
-
-working_geometry = boundary_polygon
-contour_differences = []
-
-for geom in contour_geometries[:-1]:
-    # We drop the last one because it's going to be empty
-    working_geometry = working_geometry.difference(geom)
-    contour_differences.append(working_geometry)
+# that are *higher* than that contour. Rather than building all of these
+# up front, they are made one at a time as the main loop reaches them.
+
+#-STEP 2: Subtract each contour poly from our rectangle as we go along--
+def contour_stream(window,bands,lines):
+    # We start with a simple rectangle covering the window & subtract
+    # the lowest band from it. The next time around we subtract the
+    # 2nd-lowest band from that result, and so on. Only the latest
+    # result is kept, and is handed to the main loop as a Contour, along
+    # with all the lines at that level, dissolved together. For
+    # raster_clipping there are no bands, & so no polygon either.
+    
+    working_geometry = None
+    if not raster_clipping:
+        working_geometry = QgsGeometry.fromRect(window.extent())
+    
+    for level in sorted(lines):
+        band = bands.pop(level, None)
+        if band is not None:
+            with timed('contour polygons'):
+                working_geometry = working_geometry.difference(
+                                       wkb_geometry(band))
+        
+        dissolved_line = QgsGeometry.collectGeometry(
+            [wkb_geometry(wkb) for wkb in lines.pop(level)])
+        count('contours')
+        
+        # Each Contour carrys a record of its corresponding poly for use
+        # by haircut. Once the main loop moves on, it can be let go.
+        yield Contour(dissolved_line,working_geometry,level)
+
+#=================WINDOWS: Processing the DEM in pieces=================
+#---------Points the sampling functions at a given window's rasters-----
+def open_window(window):
+    global extent, rows, cols, slope_array, aspect_array, elevation_array
+    
+    extent = window.extent()
+    rows = window.height
+    cols = window.width
+    
+    if shared_slope is not None:
+        # Views onto the shared rasters; nothing is copied
+        window_rows = slice(window.row_off, window.row_off + rows)
+        window_cols = slice(window.col_off, window.col_off + cols)
+        slope_array = shared_slope[window_rows,window_cols]
+        aspect_array = shared_aspect[window_rows,window_cols]
+        if shared_elevation is not None:
+            elevation_array = shared_elevation[window_rows,window_cols]
+        return
+    
+    # Both rasters are read once into NumPy arrays, which every sampling
+    # function reads from directly
+    slope_array = load_raster_array(slope_layer.source(),window)
+    aspect_array = load_raster_array(aspect_layer.source(),window)
+    
+    # raster_clipping also needs the elevations themselves
+    elevation_array = None
+    if raster_clipping:
+        elevation_array = load_raster_array(dem_path,window)
+
+#------Runs the whole hachure process over a single window of the DEM---
+def hachure_window(window,tile_number = 0,sink = None,checkpoints = False,
+                   state = None):
+    global current_hachures, hachure_index, rng, lod
+    
+    # Each tile gets its own seed, so a tile always makes the same random
+    # choices no matter which process happens to work on it. Without a
+    # seed, the choices are fresh each time
+    if random_seed is not None:
+        rng = random.Random(f'{random_seed}-{tile_number}')
+    else:
+        rng = random.Random()
+    
+    lod = None
+    if lod_levels > 0:
+        lod = LevelsOfDetail(lod_levels)
+        if random_seed is not None:
+            lod.rng.seed(f'{random_seed}-{tile_number}-lod')
+    
+    open_window(window)
+    bands,lines = window_contours(window)
     
-#------------------STEP 4: Dissolve the contour lines-------------------
-contour_dict = defaultdict(list)
+    # The hachures being worked on are kept in a HachureStore, keyed by
+    # their ids, so any one of them can be found or swapped out right
+    # away. Alongside it we keep a spatial index of their bounding boxes,
+    # so that each contour ring only has to be checked against nearby ones
+    
+    current_hachures = HachureStore(next_hachure_id)
+    hachure_index = QgsSpatialIndex()
+    
+    # As we iterate through, it's possible that it takes a few contour
+    # lines before the slope is high enough (i.e. > min_slope) to make
+    # hachures. So each time, the if statement checks to see if we got
+    # anything back. Otherwise it moves to the next line and again tries
+    # to generate a set of starting hachures.
+    
+    started = False
+    contours_done = 0
+    
+    if state is not None:
+        # Resuming, so put everything back as it was at the checkpoint
+        restore_checkpoint(state)
+        started = state['started']
+        contours_done = state['contours_done']
+    
+    contours = contour_stream(window,bands,lines)
+    
+    # Each contour's polygon is made from the one before, so we still
+    # have to walk through any that were done before a checkpoint
+    for skipped in range(contours_done):
+        next(contours, None)
+    
+    # NullValues may come from the prefetching thread, so it's only
+    # reported (which can touch the QGIS window) back here
+    try:
+        for number,line in enumerate(prefetched(contours,prefetch_contours),
+                                     contours_done):
+            if started:
+                subsequent_contour(line)
+            else:
+                first_contour(line)
+                started = bool(current_hachures)
+            
+            # If we're writing to a file, every so often we hand over the
+            # hachures that are done with, so they needn't be kept around
+            if sink is not None and number % 10 == 9:
+                sink.add(finished_hachures(line,window))
+                
+            if checkpoints and (number + 1) % checkpoint_every == 0:
+                save_checkpoint(number + 1,started,sink)
+    except NullValues:
+        warn_user(12)
+    
+    return output_features(
+        [hachure_id for hachure_id in current_hachures.ids()
+         if window.owns(current_hachures.start(hachure_id))])
 
-for feature in line_contours.getFeatures():
-    contour_dict[feature.attributeMap()['ELEV']].append(feature)
-    #this dict is now of the form {Elevation: [list of features]}
+#-------Turns the hachures leaving a window into QgsFeatures, at last----
+def output_features(hachure_ids):
+    features = current_hachures.features(hachure_ids)
+    
+    # With levels of detail, each one carries how far along it stays in
+    # each level, for finish_levels to cut it up by
+    if lod is not None:
+        for feature in features:
+            feature.setAttributes(lod.distances(
+                feature.id(), current_hachures.parts(feature.id())))
+    
+    return features
+
+#------Takes out the hachures that no later contour can change---------
+def finished_hachures(contour,window):
+    # Hachures only grow uphill, & the contour's polygon covers all the
+    # ground above it. So a hachure that doesn't reach into the polygon
+    # won't be crossed by any later contour, & is as long as it'll get
+    hachure_ids = current_hachures.ids()
+    
+    if raster_clipping:
+        # Without a polygon, we go by the DEM. Every vertex has to be
+        # well below the level, just as RasterClipper would want. All
+        # the vertices are sampled in one go, then split up by hachure
+        margin = contour_interval * 0.1
+        vertices,counts = current_hachures.vertex_columns(hachure_ids)
+        highest = np.full(len(hachure_ids), -np.inf)
+        if len(vertices):
+            heights = sample_many(vertices[:,0],vertices[:,1],2,
+                                  bilinear = True)
+            has_vertices = counts > 0
+            firsts = np.cumsum(counts) - counts
+            highest[has_vertices] = np.maximum.reduceat(
+                                        heights, firsts[has_vertices])
+        finished = [hachure_id for hachure_id,height
+                    in zip(hachure_ids, highest)
+                    if height < contour.level - margin]
+    else:
+        engine = QgsGeometry.createGeometryEngine(
+                     contour.polygon.constGet())
+        engine.prepareGeometry()
+        
+        # Those whose boxes miss the polygon's box altogether are let go
+        # of straight away, checking all the boxes at once
+        missed = current_hachures.outside(hachure_ids,
+                                          contour.polygon.boundingBox())
+        finished = [hachure_id for hachure_id,outside
+                    in zip(hachure_ids, missed.tolist())
+                    if outside or not engine.intersects(
+                        current_hachures.geometry(hachure_id).constGet())]
+    
+    # Only the ones that belong to this window are passed on, but all of
+    # them can be let go of
+    kept = output_features(
+        [hachure_id for hachure_id in finished
+         if window.owns(current_hachures.start(hachure_id))])
     
-keys = list(contour_dict.keys())
-keys.sort()
+    for hachure_id in finished:
+        remove_hachure(hachure_id)
+        if lod is not None:
+            lod.reach.pop(hachure_id, None)
+        
+    return kept
+
+#----------Splits the DEM into overlapping tiles of tile_size-----------
+def tile_windows():
+    windows = []
+    for row_off in range(0, dem_rows, tile_size):
+        for col_off in range(0, dem_cols, tile_size):
+            width = min(tile_size, dem_cols - col_off)
+            height = min(tile_size, dem_rows - row_off)
+            windows.append(padded_window(col_off,row_off,width,height))
+            
+    return windows
 
-# we need to sort these low-to-high so they match the order of the
-# contour_differences we just generated
+#-------A window whose core is the given pixels, with a halo round it----
+def padded_window(col_off,row_off,width,height):
+    core = Window(col_off,row_off,width,height).bounds()
+    
+    left,top,right,bottom = grown_pixels(col_off,row_off,width,height,
+                                         halo_pixels())
+    
+    return Window(left,top,right - left,bottom - top,core)
+
+def halo_pixels():
+    # Wide enough that a hachure starting inside the core can be traced
+    # its full 150 steps (3px each), and that the contour segments
+    # either side of it are still seen in full
+    return 151 * 3 + math.ceil(max_hachure_spacing * 3)
+
+def grown_pixels(col_off,row_off,width,height,margin):
+    # The left, top, right & bottom of a box of pixels grown by margin
+    # on every side, but kept inside the DEM
+    return (max(0, col_off - margin), max(0, row_off - margin),
+            min(dem_cols, col_off + width + margin),
+            min(dem_rows, row_off + height + margin))
+
+#-----------Joins up the hachures from every tile into one list---------
+def stitch_tiles(tile_hachures):
+    # Each tile only kept the hachures starting inside its own core, so
+    # no hachure turns up twice. But neither tile could see exactly what
+    # the other would do, so by a seam their hachures can start in
+    # nearly the same spot, or run alongside & across each other once
+    # past it. Wherever a hachure comes closer than min_spacing to one
+    # from an earlier tile, it's cut back to just before that point (or
+    # dropped, if it starts there), so the earlier tile's one wins.
+    # Returns the hachures in the order given
+    
+    line_index = QgsSpatialIndex()
+    lines = {}
+    kept = []
+    
+    for tile_number,hachures in enumerate(tile_hachures):
+        for hachure in hachures:
+            geometry = hachure.geometry()
+            
+            if not geometry.isEmpty():
+                search_area = geometry.boundingBox()
+                search_area.grow(min_spacing)
+                
+                crowding = [other for other,other_tile
+                            in (lines[line_id] for line_id
+                                in line_index.intersects(search_area))
+                            if other_tile != tile_number and
+                            other.distance(geometry) < min_spacing]
+                
+                if crowding:
+                    geometry = clear_stretch(geometry,crowding)
+                    if geometry is None:
+                        continue
+                    hachure = QgsFeature(hachure)
+                    hachure.setGeometry(geometry)
+                    
+                line_id = len(lines)
+                line_index.addFeature(line_id, geometry.boundingBox())
+                lines[line_id] = (geometry,tile_number)
+            
+            kept.append(hachure)
+            
+    return kept
 
-dissolved_lines = []
-for key in keys:
-    geometries = [f.geometry() for f in contour_dict[key]]
-    combined_geo = QgsGeometry.collectGeometry(geometries)
-    dissolved_lines.append(combined_geo)
+#---The start of a hachure, up to where it gets too near other lines----
+def clear_stretch(geometry,others):
+    # None if it starts too near them already
+    start = geometry.vertexAt(0)
+    crowded = QgsGeometry.collectGeometry(others).buffer(min_spacing, 4)
+    
+    if crowded.intersects(QgsGeometry.fromPointXY(QgsPointXY(start))):
+        return None
+    
+    # Cutting out the crowded bits leaves the piece from the start first
+    for piece in geometry.difference(crowded).asGeometryCollection():
+        if piece.vertexAt(0) == start:
+            return piece
+    
+    return None
+                         
+#=========CHECKPOINTS: Picking a long run back up where it stopped======
+# Settings that change which hachures get made, or which layers are
+# written. A checkpoint saved with different ones would carry on making
+# different hachures (or add to the wrong files)
+checkpoint_settings = [
+    'dem_path', 'contour_interval', 'min_hachure_spacing',
+    'max_hachure_spacing', 'min_slope_val', 'max_slope_val', 'random_seed',
+    'raster_clipping', 'lod_levels', 'lod_zoom', 'native_terrain',
+    'thickness_layer', 'tile_size', 'dem_hash'
+]
 
-# then turn them into Contours for use by the main loop
-contour_lines = []    
-for dissolved_line,poly_geometry in zip(dissolved_lines,contour_differences):
-    contour_lines.append(Contour(dissolved_line,poly_geometry))
+#------Saves everything the main loop needs to carry on from here-------
+@timed('checkpoints')
+def save_checkpoint(contours_done,started,sink):
+    # Anything handed to the file so far is written out first, so that
+    # the file & the checkpoint agree on what's been done
+    if sink is not None:
+        sink.flush()
+    
+    state = {
+        'settings': {name: globals()[name] for name in checkpoint_settings},
+        'contours_done': contours_done,
+        'started': started,
+        'next_hachure_id': next_hachure_id,
+        'random_state': rng.getstate(),
+        'lod': None if lod is None else lod.state(),
+        'hachures': tuple(np.array(array, copy = True) for array
+                          in current_hachures.to_geoarrow()),
+        'written': None if sink is None else sink.progress()
+    }
+    
+    # Written alongside & then swapped in, so a crash part way through
+    # saving leaves the last checkpoint as it was
+    scratch = checkpoint_file + '.partial'
+    with gzip.open(scratch,'wb') as checkpoint:
+        pickle.dump(state, checkpoint, pickle.HIGHEST_PROTOCOL)
+    os.replace(scratch, checkpoint_file)
+    
+    count('checkpoints')
 
-#each Contour carrys a record of its corresponding poly for use by haircut
+#-----Reads the last checkpoint back, if there is one to resume from----
+def load_checkpoint(writing = False):
+    if not (resume and checkpoint_file and os.path.exists(checkpoint_file)):
+        return None
+    
+    with gzip.open(checkpoint_file,'rb') as checkpoint:
+        state = pickle.load(checkpoint)
+    
+    # A run that was writing to a file has already let go of some of its
+    # hachures, so it has to carry on writing to that file
+    settings = {name: globals()[name] for name in checkpoint_settings}
+    if (state['settings'] != settings or
+        (state['written'] is not None) != writing):
+        warn_user(14)
+    
+    return state
 
-instance.removeMapLayer(filled_contours) # no longer needed
-                         
-#========MAIN LOOP: Iterate through Contours to generate hachures=======
+#-------Puts the hachures, ids & random choices back as they were-------
+def restore_checkpoint(state):
+    global next_hachure_id, current_hachures
+    
+    next_hachure_id = state['next_hachure_id']
+    rng.setstate(state['random_state'])
+    if lod is not None:
+        lod.restore(state['lod'])
+    
+    # Hachures come back in the same order they were in, so everything
+    # after goes exactly the same way
+    ids = state['hachures'][0]
+    current_hachures = HachureStore(int(ids[0]) if len(ids) else
+                                    next_hachure_id)
+    current_hachures.add_geoarrow(*state['hachures'])
+    for hachure_id in current_hachures.ids():
+        index_hachure(hachure_id)
+
+#==============PARALLEL: Sharing the tiles among processes==============
+# Settings that the worker processes need copied over from this one
+worker_settings = [
+    'min_hachure_spacing', 'max_hachure_spacing', 'vectorized_tracing',
+    'max_raster_memory', 'random_seed', 'dem_path', 'contour_interval',
+    'min_slope', 'max_slope', 'slope_range', 'dem_rows', 'dem_cols',
+    'cell_width', 'cell_height', 'average_pixel_size', 'jump_distance',
+    'min_spacing', 'max_spacing', 'spacing_range', 'cache_size', 'dem_hash',
+    'raster_clipping', 'lod_levels', 'lod_zoom', 'prefetch_contours'
+]
 
-current_hachures = None
+# Worker processes load this same script as a module before they start.
+# The file name has a space in it, so it can't simply be imported
+
+worker_bootstrap = """
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('hachure_generator',
+                                              script_path)
+module = importlib.util.module_from_spec(spec)
+sys.modules['hachure_generator'] = module
+spec.loader.exec_module(module)
+module.start_worker(settings, shared, prefix_path)
+"""
+
+#---------Finds this script's file, so workers can load it too----------
+def find_script_module():
+    if __name__ == 'hachure_generator':
+        return sys.modules[__name__]
+    
+    # The QGIS console doesn't always tell us where the script lives
+    script_path = globals().get('__file__')
+    if script_path is None or not os.path.isfile(script_path):
+        return None
+    
+    return load_script_module(script_path)
+
+def load_script_module(script_path):
+    spec = importlib.util.spec_from_file_location('hachure_generator',
+                                                  script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['hachure_generator'] = module
+    spec.loader.exec_module(module)
+    
+    return module
 
-# As we iterate through, it's possible that it takes a few contour lines
-# before the slope is high enough (i.e. > min_slope) to make hachures.
-# So each time, the if statement checks to see if we got anything back.
-# Otherwise it moves to the next line and again tries to generate
-# a set of starting hachures.
+#------Finds a Python to start workers with (QGIS itself isn't one)------
+def python_executable():
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    
+    name = 'python.exe' if os.name == 'nt' else 'python3'
+    for folder in (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin'),
+                   os.path.dirname(sys.executable)):
+        candidate = os.path.join(folder, name)
+        if os.path.isfile(candidate):
+            return candidate
+    
+    return sys.executable
+
+#----Copies a whole raster band into memory every process can read-----
+def share_raster_array(path):
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+    
+    memory = shared_memory.SharedMemory(
+        create = True, size = width * height * dtype.itemsize)
+    array = np.ndarray((height, width), dtype = dtype, buffer = memory.buf)
+    
+    strip_rows = max(1, (64 * 2**20) // (width * dtype.itemsize))
+    for top in range(0, height, strip_rows):
+        strip_height = min(strip_rows, height - top)
+        array[top:top + strip_height] = band.ReadAsArray(
+            0, top, width, strip_height)
+    
+    return memory,(memory.name, array.shape, dtype.str)
 
-for line in contour_lines:
-     if current_hachures:
-         subsequent_contour(line)
-     else:
-         first_contour(line)
+#-----------Sets up a worker process before it is given any tiles-------
+def start_worker(settings,shared,prefix_path):
+    global qgis_app, instance, dem_extent, worker_memory
+    global shared_slope, shared_aspect, shared_elevation
+    
+    # Each worker runs its own copy of QGIS, without any windows
+    qgis_app = start_qgis(prefix_path)
+    
+    globals().update(settings)
+    instance = QgsProject.instance()
+    dem_extent = QgsRectangle(*settings['dem_bounds'])
+    
+    # Attach to the parent's rasters. The memory handles are kept
+    # around for as long as the worker lives, or the views would break
+    worker_memory = []
+    views = []
+    for name,shape,dtype in shared:
+        memory = shared_memory.SharedMemory(name = name)
+        worker_memory.append(memory)
+        views.append(np.ndarray(shape, dtype = dtype, buffer = memory.buf))
+    
+    shared_slope,shared_aspect = views[:2]
+    if len(views) > 2:
+        shared_elevation = views[2]
 
-# If something went wrong and we got no hachures, let the user know
+#---------------Hachures a single tile inside a worker------------------
+def hachure_tile(tile_number,window_spec):
+    global next_hachure_id
+    
+    # Every worker counts ids from 0, so each tile gets a range of its own
+    next_hachure_id = tile_number * 2**32
+    
+    reset_timings()
+    hachures = hachure_window(Window(*window_spec),tile_number)
+    
+    # Geometries travel back to the parent as WKB, along with their ids,
+    # attributes & the timings
+    wkb_list = [(h.id(), bytes(h.geometry().asWkb()), h.attributes())
+                for h in hachures]
+    
+    return wkb_list,timing_report()
+
+#--------Runs the tiles across several processes & gathers results------
+def hachure_tiles_parallel(windows):
+    module = find_script_module()
+    if module is None:
+        warn_user(13)
+        return [hachure_window(w,n) for n,w in enumerate(windows)]
+    
+    settings = {name: globals()[name] for name in worker_settings}
+    settings['dem_bounds'] = Window(0,0,dem_cols,dem_rows).bounds()
+    
+    # raster_clipping also needs the elevations shared
+    paths = [slope_layer.source(), aspect_layer.source()]
+    if raster_clipping:
+        paths.append(dem_path)
+    memories,shared = zip(*[share_raster_array(path) for path in paths])
+    
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_executable())
+    
+    initargs = (worker_bootstrap, {
+        'script_path': module.__file__,
+        'settings': settings,
+        'shared': shared,
+        'prefix_path': QgsApplication.prefixPath()
+    })
+    
+    try:
+        with ProcessPoolExecutor(parallel_workers, mp_context = context,
+                                 initializer = exec,
+                                 initargs = initargs) as executor:
+            # Results are collected in tile order, not finishing order,
+            # so stitching them together always goes the same way
+            futures = [executor.submit(module.hachure_tile, n, w.spec())
+                       for n,w in enumerate(windows)]
+            results = [future.result() for future in futures]
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    
+    tile_hachures = []
+    for wkb_list,report in results:
+        add_timings(report)
+        hachures = []
+        for hachure_id,wkb,attributes in wkb_list:
+            geometry = QgsGeometry()
+            geometry.fromWkb(wkb)
+            feature = QgsFeature(hachure_id)
+            feature.setGeometry(geometry)
+            feature.setAttributes(attributes)
+            hachures.append(feature)
+        tile_hachures.append(hachures)
+    
+    return tile_hachures
 
-if current_hachures == None:
-    warn_user(11)
+#========MAIN LOOP: Work through the DEM to generate hachures===========
 
-# We sometimes pick up errant duplicates, so let's clean the final list
-current_hachures = list(set(current_hachures))
+# Hachure ids are never reused, even from one window to the next
+next_hachure_id = 0
 
-# Also occasionally hachure lines end up being multipart (if they cross
-# over a contour line that has a tight bend). So break those open.
+def generate_all_hachures(sink = None,state = None):
+    # Returns all the hachures, or if given a sink, hands them to it as
+    # they're finished & returns none. A state from load_checkpoint
+    # carries on from there
+    whole_dem = Window(0,0,dem_cols,dem_rows)
 
-separated = []
+    if tile_size > 0:
+        windows = tile_windows()
+    else:
+        windows = [whole_dem]
 
-for hachure in current_hachures:
-    geom = hachure.geometry()
-    if geom.isMultipart():
-        parts = geom.asMultiPolyline()
-        for part in parts:
-            f = QgsFeature()
-            f.setGeometry(QgsGeometry.fromPolylineXY(part))
-            separated.append(f)
+    if len(windows) > 1 and parallel_workers > 1:
+        tile_hachures = hachure_tiles_parallel(windows)
+    elif len(windows) > 1:
+        tile_hachures = [hachure_window(window,tile_number)
+                         for tile_number,window in enumerate(windows)]
+    else:
+        # Only a single window can hand over its hachures as it goes.
+        # Tiles are all needed at once, to be stitched together
+        tile_hachures = [hachure_window(whole_dem,0,sink,
+                                        checkpoint_file is not None,
+                                        state)]
+
+    if len(windows) > 1:
+        hachures = stitch_tiles(tile_hachures)
+        
+        # The thickness layer samples slopes anywhere on the DEM
+        if thickness_layer is True:
+            open_window(whole_dem)
     else:
-        separated.append(hachure)
+        hachures = tile_hachures[0]
+
+    if sink is not None:
+        sink.add(hachures)
+        hachures = []
 
-# We should filter out tiny stub features for a pleasant final result
+    # If something went wrong and we got no hachures, let the user know
 
-filtered = [f for f in separated
-            if f.geometry().length() > min_spacing * 2]
+    if not hachures and (sink is None or sink.received == 0):
+        warn_user(11)
+        
+    return hachures
 
-# Add it to the map & also add length attributes so user can filter
+#===================OUTPUT: Tidy up the finished hachures===============
+def finish_hachures(hachures):
+    if lod_levels > 0:
+        return finish_levels(hachures)
+    
+    # Occasionally hachure lines end up being multipart (if they
+    # cross over a contour line that has a tight bend). So break those.
+
+    separated = []
+    starts = {}
+
+    for hachure in hachures:
+        geom = hachure.geometry()
+        # Where the whole hachure starts, before any part is dropped
+        starts[hachure.id()] = hachure_start(hachure)
+        if geom.isMultipart():
+            parts = geom.asMultiPolyline()
+            for part in parts:
+                f = QgsFeature(hachure.id())
+                f.setGeometry(QgsGeometry.fromPolylineXY(part))
+                separated.append(f)
+        else:
+            separated.append(hachure)
 
-hachureLayer = QgsVectorLayer('linestring','Main Hachures','memory')
-hachureLayer.setCrs(DEM.crs())
+    # We should filter out tiny stub features for a pleasant result
 
-field = QgsField('Length', QVariant.Double)
-hachureLayer.dataProvider().addAttributes([field])
-hachureLayer.updateFields()
+    filtered = [f for f in separated
+                if f.geometry().length() > min_spacing * 2]
 
-for feature in separated:
-    feature.setAttributes([feature.geometry().length()])
+    # Also add length attributes so user can filter, & which hachure
+    # each line came from (the parts of one share it) & where it starts
 
-with edit(hachureLayer):
-    hachureLayer.dataProvider().addFeatures(filtered)
+    for feature in filtered:
+        feature.setAttributes([feature.geometry().length(), feature.id(),
+                               *starts[feature.id()]])
+    
+    return filtered
+
+#-----The same, but cutting each hachure up by the zooms it's shown at---
+def finish_levels(hachures):
+    # Each hachure carries how far along it stays in each level out
+    # (see LevelsOfDetail.distances). The stretch from where it leaves
+    # one level to where it leaves the next one in is first shown at
+    # that level's zoom. Stubs are filtered out just as above, & the
+    # Length is that of each stretch
+    finished = []
+    
+    for hachure in hachures:
+        geom = hachure.geometry()
+        total = geom.length()
+        distances = hachure.attributes() or [0.0] * lod_levels
+        
+        start = hachure_start(hachure)
+        
+        breaks = ([0.0] + [min(d, total) for d in reversed(distances)] +
+                  [total])
+        zooms = [lod_zoom - level for level in range(lod_levels, -1, -1)]
+        
+        offset = 0.0
+        for part in geom.asGeometryCollection():
+            length = part.length()
+            if length > min_spacing * 2:
+                for start,end,zoom in zip(breaks, breaks[1:], zooms):
+                    start = max(start - offset, 0)
+                    end = min(end - offset, length)
+                    if end - start <= 1e-9:
+                        continue
+                    piece = QgsGeometry(
+                        part.constGet().curveSubstring(start,end))
+                    feature = QgsFeature()
+                    feature.setGeometry(piece)
+                    feature.setAttributes([piece.length(), zoom,
+                                           hachure.id(), *start])
+                    finished.append(feature)
+            offset += length
+    
+    return finished
+
+#--------A fingerprint of the hachures, for checking runs match---------
+def output_digest(hachures):
+    # Each hachure's exact coordinates, sorted so that the order they
+    # came out in doesn't matter. Two runs with the same digest made
+    # exactly the same lines, down to the last bit
+    lines = sorted(tuple(coord for vertex in h.geometry().vertices()
+                         for coord in (vertex.x(), vertex.y()))
+                   for h in hachures)
     
-instance.addMapLayer(hachureLayer)
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(len(line).to_bytes(4, 'little'))
+        digest.update(np.array(line, dtype = '<f8').tobytes())
+        
+    return digest.hexdigest()
+
+#--------The fields of the hachure layers, whichever way they're made----
+def output_fields(field_name,hachure_ids = False):
+    fields = [QgsField(field_name, QVariant.Double)]
+    if lod_levels > 0:
+        fields.append(QgsField('MinZoom', QVariant.Int))
+    if hachure_ids:
+        # So the parts & stretches of one hachure can be found together,
+        # & where it started even if its first part was too short to
+        # keep, as update_hachures needs
+        fields.append(QgsField('Hachure', QVariant.LongLong))
+        fields.append(QgsField('StartX', QVariant.Double))
+        fields.append(QgsField('StartY', QVariant.Double))
+    return fields
+
+#-------------Puts the finished hachures into a memory layer------------
+def make_hachure_layer(filtered):
+    hachureLayer = QgsVectorLayer('linestring','Main Hachures','memory')
+    hachureLayer.setCrs(DEM.crs())
+
+    hachureLayer.dataProvider().addAttributes(
+        output_fields('Length', hachure_ids = True))
+    hachureLayer.updateFields()
+
+    with edit(hachureLayer):
+        hachureLayer.dataProvider().addFeatures(filtered)
+    
+    return hachureLayer
 
 #====================OPTIONAL SECTION: SPLIT HACHURES===================
 
@@ -798,74 +3060,96 @@ instance.addMapLayer(hachureLayer)
 # use their thickness to encode the slope, this will do that. Only if
 # the user parameter of thickness_layer was set True
 
-# this function splits up a hachure line feature
-def splitter(feature):
-    geo = feature.geometry()
-    
-    feat_length = geo.length()
-    
-    # Lines should be split evenly, so we don't have super-tiny stubs
-    # The jump_distance is our target length
-    
-    total_units = round(feat_length/ jump_distance)
-    
-    #this is how often we split the hachure
-    interval = feat_length / total_units 
+# Rather than cutting up each hachure & sampling each piece in turn,
+# all the hachures are laid end to end (with a small gap between each)
+# along one long distance axis. Then where every piece starts & ends,
+# its vertices & its average slope can all be found with array lookups.
+
+def split_hachures(filtered):
+    geometries = [feature.geometry() for feature in filtered]
+    if not geometries:
+        return []
     
-    start = 0
-    end = interval
+    vertices = [vertex_arrays(geometry) for geometry in geometries]
+    gap = jump_distance
     
-    output_features = []
-
-    for i in range(0,total_units):
-        line_substring = geo.constGet().curveSubstring(start,end)
-        new_feature = QgsFeature()
-        new_feature.setGeometry(line_substring)
-        output_features.append(new_feature)
-        start += interval
-        end += interval
+    # Where each vertex sits along the shared axis
+    xs = np.concatenate([x for x,y in vertices])
+    ys = np.concatenate([y for x,y in vertices])
+    steps = [np.hypot(np.diff(x), np.diff(y)) for x,y in vertices]
+    lengths = np.array([step.sum() for step in steps])
+    starts = np.concatenate([[0], np.cumsum(lengths + gap)[:-1]])
+    positions = np.concatenate([start + np.concatenate([[0], np.cumsum(step)])
+                                for start,step in zip(starts,steps)])
     
-    return output_features
+    # Lines should be split evenly, so we don't have super-tiny stubs.
+    # The jump_distance is our target length
+    units = np.round(lengths / jump_distance).astype(np.int64)
+    keep = units > 0
+    interval = lengths[keep] / units[keep]
+    piece_hachure = np.repeat(np.arange(len(lengths))[keep], units[keep])
+    piece_number = np.arange(len(piece_hachure)) - np.repeat(
+        np.cumsum(units[keep]) - units[keep], units[keep])
+    piece_interval = np.repeat(interval, units[keep])
+    piece_start = starts[piece_hachure] + piece_number * piece_interval
+    piece_end = np.minimum(piece_start + piece_interval,
+                           starts[piece_hachure] + lengths[piece_hachure])
     
-def split_slope(item):
-    # Get the average slope under a given segment
+    # The slope is sampled about every pixel along each hachure, & the
+    # running total of it (by the trapezoid rule) gives each piece's
+    # average with just 2 lookups, like a RingProfile does for rings
+    sample_positions = np.concatenate([
+        start + np.linspace(0, length,
+                            max(2, math.ceil(length / average_pixel_size) + 1))
+        for start,length in zip(starts,lengths)])
+    samples = sample_many(np.interp(sample_positions, positions, xs),
+                          np.interp(sample_positions, positions, ys), 0)
+    totals = np.concatenate([[0], np.cumsum(np.diff(sample_positions) *
+                                            (samples[1:] + samples[:-1]) / 2)])
+    piece_slope = ((np.interp(piece_end, sample_positions, totals) -
+                    np.interp(piece_start, sample_positions, totals)) /
+                   (piece_end - piece_start))
     
-    densified_line = item.geometry().densifyByDistance(average_pixel_size)
-    vertices = [(vertex.x(), vertex.y())
-                for vertex in densified_line.vertices()]
+    # Each piece runs from its start, through any vertices in between,
+    # to its end
+    start_x = np.interp(piece_start, positions, xs)
+    start_y = np.interp(piece_start, positions, ys)
+    end_x = np.interp(piece_end, positions, xs)
+    end_y = np.interp(piece_end, positions, ys)
+    first = np.searchsorted(positions, piece_start, side = 'right')
+    last = np.searchsorted(positions, piece_end, side = 'left')
     
-    row_col_coords = [xy_to_rc(c) for c in vertices]
+    splits = []
+    for i in range(len(piece_start)):
+        line = QgsLineString(
+            [start_x[i], *xs[first[i]:last[i]], end_x[i]],
+            [start_y[i], *ys[first[i]:last[i]], end_y[i]])
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry(line))
+        attributes = [float(piece_slope[i])]
+        if lod_levels > 0:
+            # Each piece is shown from the same zoom as its hachure
+            attributes.append(filtered[piece_hachure[i]].attributes()[1])
+        feature.setAttributes(attributes)
+        splits.append(feature)
+        
+    count('thickness pieces', len(splits))
     
-    samples = [sample_raster(c,0) for c in row_col_coords]
-
-    return statistics.fmean(samples)
+    return splits
 
 # Ok, now let's set up a new layer to house our split hachures
 
-if thickness_layer is True:
+def make_thickness_layer(filtered):
 
     splitHachureLayer = QgsVectorLayer('linestring','Split Hachures','memory')
     splitHachureLayer.setCrs(DEM.crs())
 
-    field = QgsField('Slope', QVariant.Double)
-    splitHachureLayer.dataProvider().addAttributes([field])
+    splitHachureLayer.dataProvider().addAttributes(output_fields('Slope'))
     splitHachureLayer.updateFields()
 
-    splits = []
-
-
-    # we then split the hachures
-    for feature in filtered:
-        splits.extend(splitter(feature))
-
-    # and assign them each the average slope in their zone
-    for feature in splits:
-        feature.setAttributes([split_slope(feature)])
-
     with edit(splitHachureLayer):
-        splitHachureLayer.dataProvider().addFeatures(splits)
-        
-    instance.addMapLayer(splitHachureLayer)
+        splitHachureLayer.dataProvider().addFeatures(
+            split_hachures(filtered))
 
     # Now make them all black, and vary in size according to their slope
     # ChatGPT wrote a lot of this for me because I had no knowledge of
@@ -895,4 +3179,491 @@ if thickness_layer is True:
     splitHachureLayer.setRenderer(renderer)
     splitHachureLayer.triggerRepaint()
     
-warn_user(0)
+    return splitHachureLayer
+
+#=========STREAMING: Writing hachures to a file as they're done=========
+#--------Opens a file (or a layer in a GeoPackage) to write lines to----
+def open_writer(path,layer_name,field_name,
+                action = QgsVectorFileWriter.CreateOrOverwriteFile,
+                hachure_ids = False):
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    extension = os.path.splitext(path)[1]
+    options.driverName = QgsVectorFileWriter.driverForExtension(extension)
+    options.layerName = layer_name
+    options.actionOnExistingFile = action
+    
+    layer_fields = QgsFields()
+    for field in output_fields(field_name,hachure_ids):
+        layer_fields.append(field)
+    
+    writer = QgsVectorFileWriter.create(
+        path, layer_fields, QgsWkbTypes.LineString, DEM.crs(),
+        QgsProject.instance().transformContext(), options)
+    
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise Exception(writer.errorMessage())
+    
+    return writer
+
+#--------Drops whatever was written to a layer after its first few------
+def truncate_layer(path,layer_name,count):
+    layer = QgsVectorLayer(f'{path}|layername={layer_name}',layer_name,'ogr')
+    
+    # Ids only ever go up as features are added, so sorting them puts
+    # the features back in the order they were written
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setNoAttributes()
+    feature_ids = sorted(f.id() for f in layer.getFeatures(request))
+    
+    layer.dataProvider().deleteFeatures(feature_ids[count:])
+
+#----Takes finished hachures & writes them out a batch at a time--------
+class HachureWriter:
+    def __init__(self,path,progress = None):
+        # Resuming from a checkpoint passes in how far it had got, so
+        # that we carry on adding to the file from there
+        self.path = path
+        self.batch = []
+        self.finished = []
+        self.received = 0
+        self.written = 0
+        self.split_written = 0
+        
+        action = QgsVectorFileWriter.CreateOrOverwriteFile
+        
+        if progress is not None:
+            if os.path.splitext(path)[1].lower() != '.gpkg':
+                warn_user(15)
+            self.received,self.written,self.split_written = progress
+            action = QgsVectorFileWriter.AppendToLayerNoNewFields
+        
+        # The thickness layer goes in a file of its own, except for a
+        # GeoPackage, where it's added as a second layer at the end. Two
+        # writers can't safely share one GeoPackage, so until then it's
+        # kept in a GeoPackage next to it
+        self.split_path = None
+        self.split_later = False
+        if thickness_layer is True:
+            stem,extension = os.path.splitext(path)
+            self.split_later = extension.lower() == '.gpkg'
+            if self.split_later:
+                self.split_path = stem + '_split.partial.gpkg'
+            else:
+                self.split_path = stem + '_split' + extension
+        
+        if progress is not None:
+            truncate_layer(path,'hachures',self.written)
+            if self.split_path:
+                truncate_layer(self.split_path,'split_hachures',
+                               self.split_written)
+        
+        self.writer = open_writer(path,'hachures','Length',action,
+                                  hachure_ids = True)
+        
+        self.split_writer = None
+        if self.split_path:
+            self.split_writer = open_writer(self.split_path,
+                                            'split_hachures','Slope',action)
+            
+    def add(self,hachures):
+        self.batch.extend(hachures)
+        self.received += len(hachures)
+        if len(self.batch) + len(self.finished) >= write_batch_size:
+            self.flush()
+    
+    def add_finished(self,hachures):
+        # Hachures that have already been through finish_hachures, like
+        # those kept from an earlier run's file
+        self.finished.extend(hachures)
+        self.received += len(hachures)
+        if len(self.batch) + len(self.finished) >= write_batch_size:
+            self.flush()
+            
+    def progress(self):
+        # How much has been handed over & written, for checkpoints
+        return self.received,self.written,self.split_written
+            
+    @timed('writing')
+    def flush(self):
+        # Finishing works a hachure at a time, so a batch at a time is
+        # just as good as all at once
+        filtered = finish_hachures(self.batch) + self.finished
+        self.batch = []
+        self.finished = []
+        
+        self.writer.addFeatures(filtered)
+        self.writer.flushBuffer()
+        self.written += len(filtered)
+        
+        if self.split_writer is not None:
+            splits = split_hachures(filtered)
+            self.split_writer.addFeatures(splits)
+            self.split_writer.flushBuffer()
+            self.split_written += len(splits)
+            
+    def close(self):
+        self.flush()
+        
+        # The files are only properly finished once the writers go
+        self.writer = None
+        self.split_writer = None
+        
+        if self.split_later:
+            split_layer = QgsVectorLayer(self.split_path,'split','ogr')
+            write_layer(split_layer, self.path, 'split_hachures',
+                        append = True)
+            del split_layer
+            os.remove(self.split_path)
+
+#=========UPDATES: Remaking the hachures around an edited patch=========
+#-----Finds the box round every pixel that differs from an older DEM-----
+def changed_pixels(old_dem_path):
+    # Returns (col_off,row_off,width,height), or None if nothing changed
+    old_dataset = gdal.Open(old_dem_path)
+    new_dataset = gdal.Open(dem_path)
+    if (old_dataset is None or
+        (old_dataset.RasterXSize, old_dataset.RasterYSize,
+         old_dataset.GetGeoTransform()) !=
+        (new_dataset.RasterXSize, new_dataset.RasterYSize,
+         new_dataset.GetGeoTransform())):
+        warn_user(16)
+    
+    old_band = old_dataset.GetRasterBand(1)
+    new_band = new_dataset.GetRasterBand(1)
+    
+    # Compared a strip at a time, so neither DEM is read in whole
+    changed_rows = np.zeros(dem_rows, dtype = bool)
+    changed_cols = np.zeros(dem_cols, dtype = bool)
+    strip_rows = max(1, (64 * 2**20) // (dem_cols * 8))
+    
+    for top in range(0, dem_rows, strip_rows):
+        height = min(strip_rows, dem_rows - top)
+        old = old_band.ReadAsArray(0, top, dem_cols, height)
+        new = new_band.ReadAsArray(0, top, dem_cols, height)
+        differ = (old != new) & ~(np.isnan(old) & np.isnan(new))
+        changed_rows[top:top + height] |= differ.any(axis = 1)
+        changed_cols |= differ.any(axis = 0)
+    
+    if not changed_rows.any():
+        return None
+    
+    row_numbers = np.flatnonzero(changed_rows)
+    col_numbers = np.flatnonzero(changed_cols)
+    
+    return (int(col_numbers[0]), int(row_numbers[0]),
+            int(col_numbers[-1] - col_numbers[0]) + 1,
+            int(row_numbers[-1] - row_numbers[0]) + 1)
+
+#------The DEM pixels covered by a box given in map units---------------
+def pixels_for_bounds(bounds):
+    # Returns (col_off,row_off,width,height), or None if the box misses
+    x_min,y_min,x_max,y_max = bounds
+    
+    left = max(0, math.floor((x_min - dem_extent.xMinimum()) / cell_width))
+    right = min(dem_cols,
+                math.ceil((x_max - dem_extent.xMinimum()) / cell_width))
+    top = max(0, math.floor((dem_extent.yMaximum() - y_max) / cell_height))
+    bottom = min(dem_rows,
+                 math.ceil((dem_extent.yMaximum() - y_min) / cell_height))
+    
+    if right <= left or bottom <= top:
+        return None
+    
+    return (left, top, right - left, bottom - top)
+
+#----Swaps the old hachures near an edited patch for freshly made ones---
+def splice_hachures(previous,changed):
+    # A hachure can only reach the edited pixels if it starts within a
+    # halo of them, so every old one starting in that wider area goes.
+    # New ones are made over it (with a halo of its own, as for a tile),
+    # & only those starting inside it are kept
+    global next_hachure_id
+    
+    left,top,right,bottom = grown_pixels(*changed, halo_pixels())
+    window = padded_window(left,top,right - left,bottom - top)
+    
+    # The old lines were split into parts (& stretches, for levels of
+    # detail) when they were finished, so they're gathered back up by
+    # hachure, in the order they were written. Each carries where its
+    # hachure started, & the hachure is kept or dropped whole
+    old_hachures = defaultdict(list)
+    for line in previous:
+        old_hachures[line.id()].append(line)
+    
+    kept = [lines for lines in old_hachures.values()
+            if not window.owns(written_start(lines[0]))]
+    
+    # New hachures mustn't reuse any of the old ones' ids
+    next_hachure_id = max(old_hachures, default = -1) + 1
+    remade = hachure_window(window)
+    
+    # The seam is dealt with just like the one between two tiles. The
+    # old lines come first, so they're all kept as they are, & the new
+    # hachures are cut back or dropped where they crowd them
+    old_lines = [line for lines in kept for line in lines]
+    stitched = stitch_tiles([old_lines, remade])
+    remade = finish_hachures(stitched[len(old_lines):])
+    count('hachures remade', len(remade))
+    
+    return [line for lines in kept for line in lines] + remade
+
+def hachure_start(hachure):
+    point = hachure.geometry().vertexAt(0)
+    return point.x(),point.y()
+
+def written_start(line):
+    # finish_hachures & finish_levels put StartX & StartY last
+    x,y = line.attributes()[-2:]
+    return x,y
+
+#=============LIBRARY: Making hachures without the console==============
+#------------------Generates hachures for a DEM file--------------------
+def generate_hachures(dem_path,params = None):
+    # Returns the finished hachures as a list of line features, each
+    # with a Length attribute. Any problems raise an Exception
+    if params is None:
+        params = HachureParameters()
+    
+    use_parameters(params)
+    
+    return hachures_for_layer(QgsRasterLayer(dem_path,'DEM'))
+
+#-------Generates hachures for a DEM file, writing them out as it goes---
+def write_hachures(dem_path,output_path,params = None):
+    # Writes to a GeoPackage, FlatGeobuf or other file that QGIS can
+    # write, & returns how many hachures were written
+    if params is None:
+        params = HachureParameters()
+    
+    use_parameters(params)
+    
+    return hachures_for_layer(QgsRasterLayer(dem_path,'DEM'), output_path)
+
+def hachures_for_layer(layer,output_path = None):
+    global DEM
+    DEM = layer
+    
+    reset_timings()
+    check_inputs()
+    prepare_terrain()
+    
+    if output_path is None:
+        hachures = generate_all_hachures(state = load_checkpoint())
+        
+        with timed('finishing'):
+            result = finish_hachures(hachures)
+    else:
+        state = load_checkpoint(writing = True)
+        progress = None if state is None else state['written']
+        sink = HachureWriter(output_path,progress)
+        generate_all_hachures(sink,state)
+        sink.close()
+        result = sink.written
+    
+    # The run got to the end, so there's nothing left to resume
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    
+    if show_timings:
+        print(timing_table())
+    
+    return result
+
+#---Remakes only the hachures around an edited patch of a DEM's file----
+def update_hachures(dem_path,previous_path,output_path,changed_bounds = None,
+                    old_dem_path = None,params = None):
+    # previous_path is an earlier run's output for the DEM before it was
+    # edited. The edited patch is either given as (x_min,y_min,x_max,
+    # y_max) in map units, or found by comparing with old_dem_path.
+    # Hachures away from it are kept exactly as they were. The params
+    # should be the ones the earlier run used. Returns how many
+    # hachures were written, which can be to previous_path itself
+    global DEM
+    
+    if params is None:
+        params = HachureParameters()
+    
+    use_parameters(params)
+    DEM = QgsRasterLayer(dem_path,'DEM')
+    
+    reset_timings()
+    check_inputs()
+    prepare_terrain()
+    
+    if changed_bounds is not None:
+        changed = pixels_for_bounds(changed_bounds)
+    else:
+        changed = changed_pixels(old_dem_path)
+    
+    # All read in first, in case the file is about to be written over
+    with timed('reading'):
+        hachures = read_hachures(previous_path)
+    
+    if changed is not None:
+        hachures = splice_hachures(hachures,changed)
+    
+    # The thickness layer samples slopes anywhere on the DEM
+    if thickness_layer is True:
+        open_window(Window(0,0,dem_cols,dem_rows))
+    
+    sink = HachureWriter(output_path)
+    sink.add_finished(hachures)
+    sink.close()
+    
+    if show_timings:
+        print(timing_table())
+    
+    return sink.written
+
+#------------Reads back the hachures written to a file------------------
+def read_hachures(path):
+    source = path
+    if os.path.splitext(path)[1].lower() == '.gpkg':
+        source += '|layername=hachures'
+    layer = QgsVectorLayer(source,'hachures','ogr')
+    if not layer.isValid():
+        raise Exception(f'Could not read hachures from {path}')
+    
+    # A file may have fields of its own (like a GeoPackage's fid), so
+    # the attributes are put back in the order they were written, & each
+    # line takes its hachure's id
+    names = [field.name() for field in output_fields('Length', True)]
+    if any(layer.fields().indexOf(name) < 0 for name in names):
+        warn_user(17)
+    
+    hachures = []
+    for line in layer.getFeatures():
+        hachure = QgsFeature(line['Hachure'])
+        hachure.setGeometry(line.geometry())
+        hachure.setAttributes([line[name] for name in names])
+        hachures.append(hachure)
+    
+    return hachures
+
+#----------Starts QGIS without any windows, for running elsewhere-------
+def start_qgis(prefix_path = None):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    
+    if prefix_path:
+        QgsApplication.setPrefixPath(prefix_path, True)
+    
+    app = QgsApplication([], False)
+    app.initQgis()
+    
+    # The processing algorithms live in one of QGIS's bundled plugins
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(),
+                                 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    
+    return app
+
+#---------Writes a layer to a GeoPackage, GeoJSON or similar file------
+def write_layer(layer,path,layer_name,append = False):
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    extension = os.path.splitext(path)[1]
+    options.driverName = QgsVectorFileWriter.driverForExtension(extension)
+    options.layerName = layer_name
+    
+    if append:
+        # Add another layer to the same GeoPackage
+        options.actionOnExistingFile = (
+            QgsVectorFileWriter.CreateOrOverwriteLayer)
+    
+    error = QgsVectorFileWriter.writeAsVectorFormatV3(
+        layer, path, QgsProject.instance().transformContext(), options)
+    
+    if error[0] != QgsVectorFileWriter.NoError:
+        raise Exception(error[1])
+
+#--------------------Runs the script from the command line--------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = 'Generate hachure lines from a DEM.')
+    parser.add_argument('dem', help = 'the DEM raster to hachure')
+    parser.add_argument('output',
+                        help = 'output file, e.g. hachures.gpkg, '
+                               'hachures.fgb or hachures.geojson')
+    parser.add_argument('--timings-json', metavar = 'PATH',
+                        help = 'also save the stage timings to this file')
+    parser.add_argument('--digest', action = 'store_true',
+                        help = 'print a fingerprint of the hachures, to '
+                               'check that two runs made the same ones')
+    parser.add_argument('--update-from', metavar = 'PATH',
+                        help = 'an earlier output to keep, remaking only '
+                               'the hachures around an edited patch')
+    parser.add_argument('--changed-bounds',
+                        metavar = 'X_MIN,Y_MIN,X_MAX,Y_MAX',
+                        help = 'with --update-from, the edited patch in '
+                               'map units')
+    parser.add_argument('--old-dem', metavar = 'PATH',
+                        help = 'with --update-from, the DEM before it was '
+                               'edited, to find the edited patch from')
+    
+    # Every parameter can be given as an option, e.g. --spacing-checks 200
+    for field in fields(HachureParameters):
+        option = '--' + field.name.replace('_', '-')
+        if field.type is bool:
+            parser.add_argument(option, default = field.default,
+                                action = argparse.BooleanOptionalAction)
+        elif field.type == Optional[int]:
+            parser.add_argument(option, default = field.default, type = int)
+        elif field.type == Optional[str]:
+            parser.add_argument(option, default = field.default)
+        else:
+            # The field's own type, as float fields have whole-number
+            # defaults (e.g. min_hachure_spacing = 2)
+            parser.add_argument(option, default = field.default,
+                                type = field.type)
+    
+    args = parser.parse_args(argv)
+    if args.update_from and not (args.changed_bounds or args.old_dem):
+        parser.error('--update-from needs --changed-bounds or --old-dem')
+    
+    params = HachureParameters(**{field.name: getattr(args, field.name)
+                                  for field in fields(HachureParameters)})
+    
+    qgis_app = start_qgis()
+    
+    # GeoPackages get the thickness layer (if wanted) as a second layer;
+    # other formats get a 2nd file
+    if args.update_from:
+        changed_bounds = None
+        if args.changed_bounds:
+            changed_bounds = [float(v) for v in args.changed_bounds.split(',')]
+        update_hachures(args.dem, args.update_from, args.output,
+                        changed_bounds, args.old_dem, params)
+    else:
+        write_hachures(args.dem, args.output, params)
+    
+    if args.digest:
+        # Read back from the file, as that's what really came out
+        print(output_digest(read_hachures(args.output)))
+    
+    if args.timings_json:
+        with open(args.timings_json, 'w') as timings_file:
+            json.dump(timing_report(), timings_file, indent = 2)
+    
+    qgis_app.exitQgis()
+
+#=========================RUN: Bake the hachures========================
+
+# Only run when the script itself is run, either in the QGIS Python
+# console or as a program. Worker processes also load this file to
+# borrow its functions, and for them nothing should happen here.
+
+if __name__ == '__console__' or (__name__ == '__main__' and iface):
+    DEM = iface.activeLayer() #The layer of interest must be selected
+    
+    filtered = hachures_for_layer(DEM)
+    
+    instance.addMapLayer(make_hachure_layer(filtered))
+    
+    if thickness_layer is True:
+        instance.addMapLayer(make_thickness_layer(filtered))
+        
+    warn_user(0)
+
+elif __name__ == '__main__':
+    main()